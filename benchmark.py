@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import threading
+import subprocess
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import path_planning
+from parameters import Parameters
+import mpcopEn
+
+#Fixed scenario set, names are the keys used when comparing two result files
+SCENARIOS = [
+    {'name': 'config1_dyn0', 'config': 'test_config1', 'n_dynobs': 0},
+    {'name': 'config1_dyn1', 'config': 'test_config1', 'n_dynobs': 1},
+    {'name': 'config2_dyn1', 'config': 'test_config2', 'n_dynobs': 1},
+    {'name': 'config2_dyn3', 'config': 'test_config2', 'n_dynobs': 3},
+    {'name': 'random0_dyn1', 'seed': 0, 'n_dynobs': 1},
+    {'name': 'random1_dyn3', 'seed': 1, 'n_dynobs': 3},
+    {'name': 'random2_dyn5', 'seed': 2, 'n_dynobs': 5},
+]
+
+
+def percentiles(samples):
+    samples = np.asarray(samples, dtype=np.float64)
+    samples = samples[~np.isnan(samples)]
+    if len(samples) == 0:
+        return {'mean': np.nan, 'p50': np.nan, 'p95': np.nan, 'p99': np.nan, 'max': np.nan}
+    return {'mean': float(samples.mean()),
+            'p50': float(np.percentile(samples, 50)),
+            'p95': float(np.percentile(samples, 95)),
+            'p99': float(np.percentile(samples, 99)),
+            'max': float(samples.max())}
+
+def bench_transport(p : Parameters, z, transports=('tcp', 'direct'), n_calls=200):
+    '''
+    Per call overhead of each solver transport
+    overhead = wall clock time of call() - solve time reported by the solver
+    '''
+    results = {}
+    for transport in transports:
+        build_dir, name = mpcopEn.open_solver(p, python_bindings=(transport == 'direct'))
+        mng = mpcopEn.start_manager(build_dir, name, transport)
+        if transport == 'direct' and not isinstance(mng, mpcopEn.DirectSolver):
+            mng.kill() #fell back to tcp, nothing to measure
+            continue
+        wall, solve = np.zeros(n_calls), np.zeros(n_calls)
+        try:
+            mng.call(z) #first call pays for connection setup / lazy init
+            for k in range(n_calls):
+                t0 = time.perf_counter()
+                sol = mng.call(z)
+                wall[k] = 1e3*(time.perf_counter() - t0)
+                solve[k] = sol.get().solve_time_ms
+        finally:
+            mng.kill()
+        results[transport] = {'wall_ms': percentiles(wall), 'overhead_ms': percentiles(wall - solve)}
+        ov = results[transport]['overhead_ms']
+        print(f'{transport}: overhead mean {ov["mean"]:.3f} ms, p50 {ov["p50"]:.3f} ms, '
+              f'p95 {ov["p95"]:.3f} ms, max {ov["max"]:.3f} ms')
+    return results
+
+def bench_planner(config='test_config2', n_queries=500, repeat_frac=0.5, seed=0):
+    '''
+    Planner throughput in queries per second, cold (every pair new) and with
+    repeat_frac of the pairs drawn again with a few cm of noise (LRU hits)
+    '''
+    rng = np.random.default_rng(seed)
+    planner = path_planning.PathPlanner.from_config(config)
+    boundary = np.asarray(planner.environment.boundary_polygon)
+    lo, hi = boundary.min(axis=0), boundary.max(axis=0)
+    points = []
+    while len(points) < 2*n_queries:
+        pt = rng.uniform(lo, hi)
+        if planner.environment.within_map(pt):
+            points.append(pt)
+    starts, goals = np.array(points[:n_queries]), np.array(points[n_queries:])
+
+    t0 = time.perf_counter()
+    paths = planner.query_batch(starts, goals)
+    cold_qps = n_queries/(time.perf_counter() - t0)
+
+    idx = np.where(rng.random(n_queries) < repeat_frac, rng.integers(0, n_queries, n_queries), -1)
+    noise = rng.normal(0.0, 0.01, (n_queries, 2))
+    mixed_starts = np.where(idx[:, None] >= 0, starts[idx] + noise, rng.permutation(starts))
+    mixed_goals = np.where(idx[:, None] >= 0, goals[idx], rng.permutation(goals))
+    planner.hits = planner.misses = 0
+    t0 = time.perf_counter()
+    planner.query_batch(mixed_starts, mixed_goals)
+    mixed_qps = n_queries/(time.perf_counter() - t0)
+
+    results = {'cold_qps': cold_qps, 'mixed_qps': mixed_qps,
+               'hit_rate': planner.hits/max(planner.hits + planner.misses, 1),
+               'no_path': sum(path is None for path in paths)}
+    print(f'{config}: {cold_qps:.1f} queries/s cold, {mixed_qps:.1f} queries/s with '
+          f'{100*results["hit_rate"]:.0f}% cache hits, {results["no_path"]} unreachable')
+    return results
+
+def scenario_problem(scn):
+    if 'config' in scn:
+        boundary, obstacles = path_planning.load_map(scn['config'])
+    else:
+        boundary, obstacles = path_planning.random_map(scn['seed'])
+    path, _ = path_planning.plan_path(boundary, obstacles)
+    p = Parameters(obstacles, boundary, scenario_dynobs(path, scn['n_dynobs']))
+    return p, path
+
+def scenario_dynobs(path, n_dynobs):
+    #Oscillating obstacles spread along the planned path so they actually interact with the run
+    dynobs = []
+    for j in range(n_dynobs):
+        x, y = path[int((j + 1)*len(path)/(n_dynobs + 1))]
+        dynobs.append(([float(x), float(y)], [float(x), float(y) + 1.0], 0.1, 0.2, 0.5, 0.1))
+    return dynobs
+
+def run_scenario(scn, transport='tcp', warm_start=True):
+    t0 = time.perf_counter()
+    p, path = scenario_problem(scn)
+    t_plan = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    ref_trajectory = path_planning.generate_reftrajectory(p, path)
+    t_ref = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    build_dir, name = mpcopEn.open_solver(p, python_bindings=(transport == 'direct'), verbose=False)
+    t_build = time.perf_counter() - t0
+
+    mng = mpcopEn.start_manager(build_dir, name, transport)
+    try:
+        controller = mpcopEn.OpEnController(p, warm_start=warm_start, mng=mng).build()
+        t0 = time.perf_counter()
+        sim_traj, commands, tel = mpcopEn.closed_loop(p, ref_trajectory, controller, verbose=False)
+        t_loop = time.perf_counter() - t0
+    finally:
+        mng.kill()
+
+    #Everything the loop spends on one control step, compared against the dt budget
+    step_ms = (tel['t_ref_ms'] + tel['t_pack_ms'] + tel['t_solve_ms'] + tel['t_dyn_ms'] + tel['t_diag_ms']
+               + np.nan_to_num(tel['t_replan_ms']))
+    return {'steps': int(tel.n),
+            'plan_time_s': t_plan,
+            'ref_time_s': t_ref,
+            'build_time_s': t_build,
+            'loop_time_s': t_loop,
+            'solve_ms': percentiles(tel['solve_time_ms']),
+            'call_ms': percentiles(tel['t_solve_ms']),
+            'step_ms': percentiles(step_ms),
+            'inner_iters': percentiles(tel['inner_iters']),
+            'deadline_misses': int(np.sum(step_ms > 1e3*p.dt)),
+            'min_clearance': float(np.nanmin(tel['clearance']))}
+
+def _scenario_process(scn, transport, warm_start):
+    res = run_scenario(scn, transport, warm_start)
+    #the TCP server is reaped by opengen's starter thread, its peak only counts once that returned
+    for thread in threading.enumerate():
+        if thread is not threading.main_thread():
+            thread.join(timeout=5.0)
+    res['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    res['peak_rss_children_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024
+    return res
+
+def measured_scenario(scn, transport='tcp', warm_start=True):
+    '''
+    run_scenario in a fresh interpreter, so the peak resident memory of the benchmark
+    process (peak_rss_mb) and of its children (peak_rss_children_mb: the TCP server and
+    cargo if the solver is not cached yet) belong to this scenario alone
+    '''
+    with ProcessPoolExecutor(1, mp_context=mp.get_context('spawn')) as pool:
+        return pool.submit(_scenario_process, scn, transport, warm_start).result()
+
+def backend_stats(tel):
+    return {'steps': int(tel.n),
+            'solve_ms': percentiles(tel['solve_time_ms']),
+            'iters': percentiles(tel['inner_iters']),
+            'violation_max': float(np.nanmax(tel['violation'])),
+            'converged': float(np.nanmean(tel['converged'])),
+            'min_clearance': float(np.nanmin(tel['clearance']))}
+
+def compare_backends(out='backends.json', scenarios=SCENARIOS, transport='tcp', max_steps=None,
+                     feasible_tol=1e-3):
+    '''
+    Head to head OpEn vs IPOPT on the same problem (build_problem) per scenario
+    shadow run: OpEn drives the loop and IPOPT solves every step with the same z, the
+    optimality gap is measured there
+    ipopt run: IPOPT drives its own closed loop, for its solve times and violations
+    along its own trajectory
+    '''
+    results = {'commit': git_commit(),
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'transport': transport,
+               'scenarios': {}}
+    for scn in scenarios:
+        p, path = scenario_problem(scn)
+        ref_trajectory = path_planning.generate_reftrajectory(p, path)
+        shadow = mpcopEn.ShadowController(mpcopEn.OpEnController(p, transport),
+                                          mpcopEn.IpoptController(p)).build()
+        try:
+            _, _, tel = mpcopEn.closed_loop(p, ref_trajectory, shadow, verbose=False, max_steps=max_steps)
+        finally:
+            shadow.close()
+        ipopt = mpcopEn.IpoptController(p).build()
+        _, _, tel_ipopt = mpcopEn.closed_loop(p, ref_trajectory, ipopt, verbose=False, max_steps=max_steps)
+
+        res = {'open': backend_stats(tel), 'ipopt': backend_stats(tel_ipopt),
+               'gap': percentiles(tel['gap']),
+               'ipopt_same_z': {'solve_ms': percentiles(tel['shadow_solve_time_ms']),
+                                'violation_max': float(np.nanmax(tel['shadow_violation']))}}
+        feasible = [name for name in ('open', 'ipopt') if res[name]['violation_max'] <= feasible_tol]
+        res['fastest_feasible'] = min(feasible, key=lambda name: res[name]['solve_ms']['p50'], default=None)
+        results['scenarios'][scn['name']] = res
+        for name in ('open', 'ipopt'):
+            st = res[name]
+            print(f'{scn["name"]:14s} {name:5s}: solve p50 {st["solve_ms"]["p50"]:.2f} ms, '
+                  f'p95 {st["solve_ms"]["p95"]:.2f} ms, max violation {st["violation_max"]:.2e}, '
+                  f'{100*st["converged"]:.0f}% converged')
+        print(f'{scn["name"]:14s} gap p50 {res["gap"]["p50"]:.2e}, p95 {res["gap"]["p95"]:.2e}, '
+              f'max {res["gap"]["max"]:.2e}, fastest feasible: {res["fastest_feasible"]}')
+    with open(out, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Saved {out}')
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(out='benchmark.json', scenarios=SCENARIOS, transport='tcp'):
+    results = {'commit': git_commit(),
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'transport': transport,
+               'scenarios': {}}
+    for scn in scenarios:
+        res = measured_scenario(scn, transport)
+        results['scenarios'][scn['name']] = res
+        print(f'{scn["name"]}: solve p50 {res["solve_ms"]["p50"]:.2f} ms, p95 {res["solve_ms"]["p95"]:.2f} ms, '
+              f'p99 {res["solve_ms"]["p99"]:.2f} ms, max {res["solve_ms"]["max"]:.2f} ms, '
+              f'{res["deadline_misses"]}/{res["steps"]} deadline misses, '
+              f'build {res["build_time_s"]:.1f} s, plan {res["plan_time_s"]:.2f} s, '
+              f'peak memory {res["peak_rss_mb"]:.0f} MB (children {res["peak_rss_children_mb"]:.0f} MB)')
+    with open(out, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Saved {out}')
+    return results
+
+def compare(old_file, new_file, metrics=('solve_ms.p50', 'solve_ms.p95', 'solve_ms.p99', 'step_ms.max',
+                                          'deadline_misses', 'build_time_s', 'plan_time_s',
+                                          'peak_rss_mb', 'peak_rss_children_mb'),
+            tolerance=0.10):
+    '''
+    Prints new/old ratios per scenario and metric, flags regressions above tolerance
+    returns the list of (scenario, metric, old, new) regressions
+    '''
+    with open(old_file) as file:
+        old = json.load(file)
+    with open(new_file) as file:
+        new = json.load(file)
+    print(f'{old.get("commit")} -> {new.get("commit")}')
+    regressions = []
+    for name in sorted(set(old['scenarios']) & set(new['scenarios'])):
+        for metric in metrics:
+            a, b = old['scenarios'][name], new['scenarios'][name]
+            try:
+                for key in metric.split('.'):
+                    a, b = a[key], b[key]
+            except KeyError:
+                print(f'{name:16s} {metric:16s} missing in one of the files')
+                continue
+            ratio = b / a if a else (np.inf if b else 1.0)
+            flag = ''
+            if ratio > 1 + tolerance and b - a > 1e-9:
+                flag = '  <-- regression'
+                regressions.append((name, metric, a, b))
+            print(f'{name:16s} {metric:16s} {a:10.3f} -> {b:10.3f}  x{ratio:.2f}{flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MPC stack benchmarks')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    suite = sub.add_parser('suite', help='closed loop benchmark over the fixed scenarios')
+    suite.add_argument('--out', default='benchmark.json')
+    suite.add_argument('--transport', default='tcp', choices=('tcp', 'direct'))
+    cmp_parser = sub.add_parser('compare', help='compare two suite result files')
+    cmp_parser.add_argument('old')
+    cmp_parser.add_argument('new')
+    cmp_parser.add_argument('--tolerance', type=float, default=0.10)
+    sub.add_parser('transport', help='per call overhead of the tcp and in-process solvers')
+    backends_parser = sub.add_parser('backends', help='OpEn vs IPOPT solve time, optimality gap and violations')
+    backends_parser.add_argument('--out', default='backends.json')
+    backends_parser.add_argument('--transport', default='tcp', choices=('tcp', 'direct'))
+    backends_parser.add_argument('--steps', type=int, default=None)
+    agents_parser = sub.add_parser('agents', help='multi-robot step latency for 1 to 16 agents')
+    agents_parser.add_argument('--config', default='test_config2')
+    agents_parser.add_argument('--backend', default='open', choices=('open', 'ipopt'))
+    agents_parser.add_argument('--steps', type=int, default=100)
+    agents_parser.add_argument('--counts', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    agents_parser.add_argument('--out', default='agents.json')
+    planner_parser = sub.add_parser('planner', help='path planner queries per second')
+    planner_parser.add_argument('--config', default='test_config2')
+    planner_parser.add_argument('--queries', type=int, default=500)
+    args = parser.parse_args()
+
+    if args.cmd == 'suite':
+        run_suite(args.out, transport=args.transport)
+    elif args.cmd == 'compare':
+        sys.exit(1 if compare(args.old, args.new, tolerance=args.tolerance) else 0)
+    elif args.cmd == 'transport':
+        path, obstacles, boundary, padded_obstacles = path_planning.gen_path('test_config2')
+        dynobs = [([8.17127, 29.0021], [8.17127, 30.0021], 0.1, 0.2, 0.5, 0.1)]
+        p = Parameters(obstacles, boundary, dynobs)
+        ref_trajectory = path_planning.generate_reftrajectory(p, path)
+        z = mpcopEn.pack_params(ref_trajectory[0, :p.n_states], np.zeros(p.n_cmds), ref_trajectory[:p.N_hor+1], p, 0.0)
+        bench_transport(p, z)
+    elif args.cmd == 'backends':
+        compare_backends(args.out, transport=args.transport, max_steps=args.steps)
+    elif args.cmd == 'agents':
+        import multiagent
+        results = {'commit': git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'backend': args.backend, 'cpus': os.cpu_count(),
+                   'agents': multiagent.latency_scaling(args.config, args.counts, args.backend, args.steps)}
+        with open(args.out, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'Saved {args.out}')
+    elif args.cmd == 'planner':
+        bench_planner(args.config, args.queries)
@@ -0,0 +1,163 @@
+import os
+import sys
+import time
+import argparse
+
+#Headless entry point, every subcommand imports only what it needs so solver-only
+#workers never load matplotlib, imageio or PIL
+#  python cli.py plan test_config2                  -> runs/test_config2_plan.npz
+#  python cli.py build test_config2
+#  python cli.py simulate test_config2              -> runs/test_config2.npz (+ _telemetry.npz)
+#  python cli.py render runs/test_config2.npz       -> postrun_plots/together.gif
+#  python cli.py startup                            import cost per subcommand
+
+#Modules each subcommand imports, measured by startup
+IMPORTS = {'plan': ('numpy', 'scenario'),
+           'build': ('scenario', 'mpcopEn'),
+           'simulate': ('numpy', 'scenario', 'mpcopEn'),
+           'simulate --realtime': ('numpy', 'scenario', 'mpcopEn', 'realtime'),
+           'render': ('numpy', 'scenario', 'plotting'),
+           'main.py': ('main',)} #the interactive script, for reference
+
+
+def _run_path(args, suffix=''):
+    return args.out or os.path.join('runs', f'{args.config}{suffix}.npz')
+
+def _save(out, **arrays):
+    import numpy as np
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    np.savez(out, **arrays)
+    print(f'Saved {out}')
+
+def plan(args):
+    import numpy as np
+    import scenario
+    t0 = time.perf_counter()
+    p, path, ref_trajectory, _ = scenario.load_scenario(args.config, args.scenarios).reference()
+    print(f'{args.config}: {len(path)} path points, {len(ref_trajectory)} reference samples '
+          f'({len(ref_trajectory)*p.dt:.1f} s) in {time.perf_counter() - t0:.2f} s')
+    _save(_run_path(args, '_plan'), path=path, ref_trajectory=ref_trajectory, config=np.array(args.config))
+
+def build(args):
+    import scenario
+    import mpcopEn
+    p = scenario.load_scenario(args.config, args.scenarios).params()
+    t0 = time.perf_counter()
+    build_dir, name = mpcopEn.open_solver(p, rebuild=args.rebuild, python_bindings=(args.transport == 'direct'),
+                                          verbose=args.verbose)
+    print(f'{build_dir}/{name} ready in {time.perf_counter() - t0:.1f} s')
+
+def simulate(args):
+    import numpy as np
+    import scenario
+    import mpcopEn
+    scn = scenario.load_scenario(args.config, args.scenarios)
+    if args.plan:
+        p = scn.params()
+        with np.load(args.plan) as file:
+            ref_trajectory = file['ref_trajectory']
+    else:
+        p, _, ref_trajectory, _ = scn.reference()
+    out = _run_path(args)
+    telemetry_path = os.path.splitext(out)[0] + '_telemetry.npz'
+    t0 = time.perf_counter()
+    if args.realtime is not None:
+        import realtime
+        controller = mpcopEn.make_controller(p, args.backend, args.transport, not args.cold).build()
+        try:
+            sim_traj, commands, _ = realtime.run_realtime(p, ref_trajectory, controller, args.realtime,
+                                                          verbose=args.verbose, telemetry_path=telemetry_path)
+        finally:
+            controller.close()
+    else:
+        sim_traj, commands = mpcopEn.run_mpc(p, ref_trajectory, warm_start=not args.cold, transport=args.transport,
+                                             verbose=args.verbose, backend=args.backend,
+                                             telemetry_path=telemetry_path)
+    print(f'{args.config}: {len(commands)} steps in {time.perf_counter() - t0:.1f} s')
+    _save(out, sim_traj=np.asarray(sim_traj), commands=commands, ref_trajectory=ref_trajectory,
+          config=np.array(args.config), scenarios=np.array(args.scenarios))
+
+def render(args):
+    if not args.show:
+        import matplotlib
+        matplotlib.use('Agg') #before pyplot is imported by plotting
+    import numpy as np
+    import scenario
+    import plotting
+    with np.load(args.run) as file:
+        run = {key: file[key] for key in file.files}
+    config = args.config or str(run['config'])
+    scn = scenario.load_scenario(config, args.scenarios or str(run.get('scenarios', 'obsbounds.yaml')))
+    p = scn.params()
+    os.makedirs('postrun_plots', exist_ok=True)
+    plotting.view_run_together(p.boundaries, p.obstacles, p.dynobs, run['sim_traj'], run['commands'], p,
+                               args.out, stride=args.stride, workers=args.workers)
+    if args.plots:
+        padded_obstacles = scn.planner().padded_obstacles
+        plotting.plot_traj(run['sim_traj'], run['ref_trajectory'], p.boundaries, p.obstacles, padded_obstacles,
+                           show=args.show)
+        plotting.plot_commands(run['commands'], show=args.show)
+    if args.show:
+        import matplotlib.pyplot as plt
+        plt.show()
+
+def startup(args):
+    '''
+    Import time of each subcommand's modules in a fresh interpreter, best of repeat,
+    next to the wall time of the whole process (interpreter start included)
+    '''
+    import subprocess
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name, modules in IMPORTS.items():
+        code = ('import time; t = time.perf_counter(); import ' + ', '.join(modules) +
+                '; print(1e3*(time.perf_counter() - t))')
+        imports, walls = [], []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            res = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=here)
+            walls.append(1e3*(time.perf_counter() - t0))
+            if res.returncode != 0:
+                print(f'{name:19s} failed: {res.stderr.strip().splitlines()[-1]}')
+                break
+            imports.append(float(res.stdout.split()[-1]))
+        else:
+            print(f'{name:19s} imports {min(imports):7.1f} ms, process {min(walls):7.1f} ms  ({", ".join(modules)})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless planning, solver build, simulation and rendering')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+
+    plan_parser = sub.add_parser('plan', help='plan the path and reference trajectory of a scenario')
+    build_parser = sub.add_parser('build', help='generate and compile the OpEn optimizer')
+    sim_parser = sub.add_parser('simulate', help='closed loop run, no plotting')
+    for p_ in (plan_parser, build_parser, sim_parser):
+        p_.add_argument('config', help='scenario name')
+        p_.add_argument('--scenarios', default='obsbounds.yaml')
+    for p_ in (plan_parser, sim_parser):
+        p_.add_argument('--out', default=None, help='defaults to runs/<config>[_plan].npz')
+    for p_ in (build_parser, sim_parser):
+        p_.add_argument('--transport', default='tcp', choices=('tcp', 'direct'))
+        p_.add_argument('--verbose', action='store_true')
+    build_parser.add_argument('--rebuild', action='store_true')
+    sim_parser.add_argument('--plan', default=None, help='reference from a plan .npz instead of planning again')
+    sim_parser.add_argument('--backend', default='open', choices=('open', 'ipopt'))
+    sim_parser.add_argument('--cold', action='store_true', help='no warm start')
+    sim_parser.add_argument('--realtime', type=float, default=None, metavar='SCALE',
+                            help='fixed rate wall clock loop with deadlines, SCALE x real time')
+
+    render_parser = sub.add_parser('render', help='combined GIF (and static plots) of a simulate run')
+    render_parser.add_argument('run', help='.npz written by simulate')
+    render_parser.add_argument('--config', default=None, help='defaults to the one stored in the run')
+    render_parser.add_argument('--scenarios', default=None)
+    render_parser.add_argument('--out', default='postrun_plots/together.gif')
+    render_parser.add_argument('--stride', type=int, default=1)
+    render_parser.add_argument('--workers', type=int, default=None)
+    render_parser.add_argument('--plots', action='store_true', help='also save the trajectory and command plots')
+    render_parser.add_argument('--show', action='store_true', help='open plot windows (blocks until closed)')
+
+    startup_parser = sub.add_parser('startup', help='import cost of every subcommand')
+    startup_parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    {'plan': plan, 'build': build, 'simulate': simulate, 'render': render, 'startup': startup}[args.cmd](args)
@@ -1,7 +1,12 @@
+import sys
+import time
 import numpy as np
 import matplotlib.pyplot as plt
 import casadi as ca
 import opengen as og
+import path_planning
+from mpcopEn import shift_blocks
+from telemetry import Telemetry
 
 class Parameters:
     def __init__(self, vel_min=-0.5, vel_max=1.5, ang_vel_min=-0.5, ang_vel_max=0.5, lin_acc_min=-0.1, lin_acc_max=0.1, ang_acc_min=-3.0, ang_acc_max=3.0):
@@ -59,26 +64,33 @@ def dyn_prop_np(x,u, p:Parameters):
                         thetap + p.dt*w])
 
 def angle_wrapper(angle):
-    return ca.atan2(np.sin(angle), np.cos(angle))
+    return ca.atan2(ca.sin(angle), ca.cos(angle))
 
 
-def mpc_solver(p : Parameters):
+def mpc_solver(p : Parameters, jit=False, warm_start=True):
+    '''
+    IPOPT NLP over stacked u and x, built with SX so every evaluation runs as one
+    flat expression graph
+    jit: compile the NLP functions to C (needs a C compiler), pays off for long horizons
+    warm_start: tell IPOPT to start from the primal/dual guess passed per call
+    (see shifted_warm_start), the first call just gets zero multipliers
+    '''
     no_x,no_u,N,dt = p.n_states, p.n_cmds, p.N_hor, p.dt
     # Define optimization variables
-    u = ca.MX.sym('u', no_u,N)  # 2 commands for each time step (v, omega)
-    x = ca.MX.sym('x',no_x,N+1)
-    x0 = ca.MX.sym('x0',no_x)  # Initial state
-    ref = ca.MX.sym('ref',no_x,N+1) #ref traj with final pos and heading
-    u0 = ca.MX.sym('u0',no_u)  #Previous command 
+    u = ca.SX.sym('u', no_u,N)  # 2 commands for each time step (v, omega)
+    x = ca.SX.sym('x',no_x,N+1)
+    x0 = ca.SX.sym('x0',no_x)  # Initial state
+    ref = ca.SX.sym('ref',no_x,N+1) #ref traj with final pos and heading
+    u0 = ca.SX.sym('u0',no_u)  #Previous command 
     
     #Initialize weights
-    Q = ca.diag(ca.MX([p.pos_dev, p.pos_dev, p.heading_dev]))  # State deviation weights
-    R = ca.diag(ca.MX([p.lin_vel_pen, p.ang_vel_pen]))  # Control effort weights
-    Ra = ca.diag(ca.MX([p.lin_acc_pen, p.ang_acc_pen]))  # Acc change weights
-    QN = ca.diag(ca.MX([p.termcost_pos, p.termcost_pos, p.termcost_heading]))  # Terminal state weights
+    Q = ca.diag(ca.DM([p.pos_dev, p.pos_dev, p.heading_dev]))  # State deviation weights
+    R = ca.diag(ca.DM([p.lin_vel_pen, p.ang_vel_pen]))  # Control effort weights
+    Ra = ca.diag(ca.DM([p.lin_acc_pen, p.ang_acc_pen]))  # Acc change weights
+    QN = ca.diag(ca.DM([p.termcost_pos, p.termcost_pos, p.termcost_heading]))  # Terminal state weights
     
     g = []  # Constraints vector
-    cost = ca.MX(0)  # Objective function
+    cost = ca.SX(0)  # Objective function
     
     # Regular constraints
     for k in range(N):
@@ -126,16 +138,38 @@ def mpc_solver(p : Parameters):
     ubg = ca.vertcat(ubg_ineq, ubg_eq)
 
     nlp = {'x': w, 'f': cost, 'g': g, 'p': ca.vertcat(x0, u0,ca.vec(ref))}
-    opts = {'ipopt': {'print_level': 0, 'max_iter': 200, 'acceptable_tol': 1e-8, 'acceptable_obj_change_tol': 1e-6}}
+    opts = {'ipopt': {'print_level': 0, 'max_iter': 200, 'acceptable_tol': 1e-8, 'acceptable_obj_change_tol': 1e-6},
+            'print_time': False}
+    if warm_start:
+        #small barrier and bound pushes so IPOPT stays near the shifted solution instead of recentering
+        opts['ipopt'].update({'warm_start_init_point': 'yes', 'warm_start_bound_push': 1e-6,
+                              'warm_start_mult_bound_push': 1e-6, 'mu_init': 1e-4})
+    if jit:
+        opts.update({'jit': True, 'compiler': 'shell', 'jit_options': {'flags': ['-O1'], 'verbose': False}})
     solver = ca.nlpsol('solver', 'ipopt', nlp, opts)
 
     def unpack_sol(w_opt):
-        u_opt = w_opt[0:no_u*N].full().reshape((no_u, N))
-        x_opt = w_opt[no_u*N:].full().reshape((no_x, N+1))
+        #casadi vec() stacks columns, so reshape column major
+        u_opt = w_opt[0:no_u*N].full().reshape((no_u, N), order='F')
+        x_opt = w_opt[no_u*N:].full().reshape((no_x, N+1), order='F')
         return u_opt, x_opt
     bounds = dict(lbg=lbg, ubg=ubg,lbx=-ca.inf, ubx=ca.inf)
     return solver, unpack_sol,bounds
 
+def shifted_warm_start(sol, p : Parameters):
+    '''
+    Primal and dual guess for the next step from this step's solution, shifted by one stage
+    w = [u (no_u per stage), x (no_x per stage)]
+    g = [vel bounds (4/stage), acc bounds (4/stage), dynamics (no_x/stage), initial state]
+    '''
+    no_x, no_u, N = p.n_states, p.n_cmds, p.N_hor
+    w_blocks = [(no_u*N, no_u), (no_x*(N+1), no_x)]
+    g_blocks = [(4*N, 4), (4*N, 4), (no_x*N, no_x), (no_x, no_x)]
+    return {'x0': shift_blocks(sol['x'].full().ravel(), w_blocks),
+            'lam_x0': shift_blocks(sol['lam_x'].full().ravel(), w_blocks),
+            'lam_g0': shift_blocks(sol['lam_g'].full().ravel(), g_blocks)}
+
+
 def plot_trajectory(ref_trajectory):
     plt.figure(figsize=(10, 6))
     plt.plot(ref_trajectory[:, 0], ref_trajectory[:, 1], 'r--', label='Reference Trajectory')
@@ -152,7 +186,11 @@ def plot_trajectory(ref_trajectory):
 # ---------- Main Simulation Loop ----------
 if __name__ == '__main__':
     p = Parameters()
-    solver, unpack_sol, bounds = mpc_solver(p)
+    jit = '--jit' in sys.argv
+    warm_start = '--cold' not in sys.argv
+    t0 = time.perf_counter()
+    solver, unpack_sol, bounds = mpc_solver(p, jit=jit, warm_start=warm_start)
+    print(f'Solver set up in {time.perf_counter() - t0:.2f} s (jit={jit}, warm_start={warm_start})')
     
     # Initial command guess
     u_prev = np.array([0.0, 0.0])
@@ -169,25 +207,31 @@ if __name__ == '__main__':
     # Storage for states and commands
     states = np.zeros((steps, p.n_states))
     commands = np.zeros((steps, p.n_cmds))
+    tel = Telemetry(steps, ('t_solve_ms', 't_eval_ms', 'iters')) #t_eval: time in NLP function evaluations
     
     sim_traj = [x.copy()]
+    tracker = path_planning.RefTracker(ref_trajectory)
+    # Initial guess, states held at the start
+    guess = {'x0': np.concatenate([np.zeros(p.n_cmds*p.N_hor), np.tile(x, p.N_hor+1)])}
     
     for t in range(steps):
         
-        # Select remaining reference trajectory 
-        end = min(t + p.N_hor, ref_trajectory.shape[0]-1)
-        segm = ref_trajectory[t:end+1,:]
-        if segm.shape[0] < p.N_hor + 1:
-            segm = np.vstack([segm,np.repeat(segm[-1][None,:], p.N_hor+1-segm.shape[0], axis=0)])
-        xref = segm
+        # Select the reference ahead of the robot's progress along the path
+        xref = tracker.window(x, p.N_hor + 1)
 
         P = np.concatenate((x.ravel(), u_prev.ravel(), xref.ravel())) #Flatten vectors for solver
-        w0 = np.zeros(p.n_cmds*p.N_hor + p.n_states*(p.N_hor+1))  # Initial guess sequence
         
-        sol = solver(x0=w0, p=P, **bounds)
-        print(f'Solver status at step {t}: {solver.stats()["return_status"]}')
+        t0 = time.perf_counter()
+        sol = solver(p=P, **guess, **bounds)
+        t_solve = 1e3*(time.perf_counter() - t0)
+        stats = solver.stats()
+        t_eval = sum(v for k, v in stats.items() if k.startswith('t_wall_nlp'))
+        tel.record(t, t_solve_ms=t_solve, t_eval_ms=1e3*t_eval, iters=stats['iter_count'])
+        print(f'Step {t}: {stats["return_status"]}, {stats["iter_count"]} iters, {t_solve:.1f} ms')
         u_opt, x_opt = unpack_sol(sol['x'])
         u_applied = u_opt[:, 0]
+        if warm_start:
+            guess = shifted_warm_start(sol, p)
 
         #Use first command
         x = np.array(dyn_prop_np(x, u_applied, p)).flatten()
@@ -195,26 +239,30 @@ if __name__ == '__main__':
         commands[t, :] = u_applied
         sim_traj.append(x.copy())
 
-# Plot simulated trajectory
-plt.figure()
-sim_traj = np.array(sim_traj)
-plt.plot(sim_traj[:,0], sim_traj[:,1], label='Simulated Trajectory')
-plt.plot(ref_trajectory[:,0], ref_trajectory[:,1], 'r--', label='Reference Trajectory')
-plt.xlabel('X Position')
-plt.ylabel('Y Position')
-plt.title('Simulated Trajectory')
-plt.legend()
-plt.axis('equal')
-plt.grid()
-plt.show()
-
-#Debugiging COmmands
-plt.figure()
-plt.plot(commands[:,0], label='v')
-plt.legend(); plt.grid(); plt.show()
-
-plt.figure()
-plt.plot(commands[:,1], label='omega')
-plt.legend(); plt.grid(); plt.show()
-
-print(f'Initial pos sim {sim_traj[0]} and initial pos ref {ref_trajectory[0]}')
\ No newline at end of file
+    print(f'Solve time mean {np.mean(tel["t_solve_ms"]):.1f} ms, p95 {np.percentile(tel["t_solve_ms"], 95):.1f} ms, '
+          f'max {np.max(tel["t_solve_ms"]):.1f} ms, function evals {np.mean(tel["t_eval_ms"]):.1f} ms, '
+          f'iters mean {np.mean(tel["iters"]):.1f}')
+
+    # Plot simulated trajectory
+    plt.figure()
+    sim_traj = np.array(sim_traj)
+    plt.plot(sim_traj[:,0], sim_traj[:,1], label='Simulated Trajectory')
+    plt.plot(ref_trajectory[:,0], ref_trajectory[:,1], 'r--', label='Reference Trajectory')
+    plt.xlabel('X Position')
+    plt.ylabel('Y Position')
+    plt.title('Simulated Trajectory')
+    plt.legend()
+    plt.axis('equal')
+    plt.grid()
+    plt.show()
+
+    #Debugiging COmmands
+    plt.figure()
+    plt.plot(commands[:,0], label='v')
+    plt.legend(); plt.grid(); plt.show()
+
+    plt.figure()
+    plt.plot(commands[:,1], label='omega')
+    plt.legend(); plt.grid(); plt.show()
+
+    print(f'Initial pos sim {sim_traj[0]} and initial pos ref {ref_trajectory[0]}')
@@ -1,13 +1,24 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.patches import Ellipse
-from matplotlib import animation
 import casadi as ca
 import opengen as og
 import path_planning
-from parameters import Parameters
-import plotting
-import yaml
+from parameters import Parameters, TUNABLE_FIELDS
+import os
+import sys
+import time
+import logging
+from telemetry import Telemetry
+import importlib.util
+import json
+import hashlib
+import inspect
+from importlib.metadata import version
+
+#Parameters fields that are fed through z at runtime and do not shape the compiled problem
+_RUNTIME_FIELDS = ('obstacles', 'boundaries', 'dynobs', 'r_safe') + TUNABLE_FIELDS
+_BUILD_STAMP = 'build_key'
+PAD_VERT = 1e3 #sentinel coordinate for unused vertex slots
+INITIAL_PENALTY = 1e4 #ALM penalty of a cold solve, a warm start carries at most 10x of it
 
 
 def dyn_prop(x,u, p:Parameters):
@@ -24,47 +35,84 @@ def dyn_prop_np(x,u, p:Parameters):
                       yp + p.dt*v*np.sin(thetap),
                         thetap + p.dt*w])
 
+def unscale_commands(s, p : Parameters):
+    #v,w sequence of a solution in the scaled decision variables s in [-1,1], see build_problem
+    lo = np.array([p.vel_min, p.ang_vel_min])
+    hi = np.array([p.vel_max, p.ang_vel_max])
+    s = np.asarray(s, dtype=np.float64).reshape(-1, p.n_cmds)
+    return (0.5*(hi + lo) + 0.5*(hi - lo)*s).ravel()
+
 def angle_wrapper(angle):
     return ca.atan2(ca.sin(angle), ca.cos(angle))
 
 
-def open_solver(p : Parameters,build_dir="build_dir", name="nmpc_open"):
-    
+def param_layout(p : Parameters):
+    '''
+    Named slices of the parameter vector z, shared by build_problem and ParamPacker
+    '''
+    N = p.N_hor
+    sizes = [('x0', p.n_states),
+             ('u_prev', p.n_cmds),
+             ('ref', p.n_ref*(N+1)),
+             static_block(p),
+             ('r_safe', 1),
+             ('tunables', len(TUNABLE_FIELDS)), #weights and bounds, see parameters.TUNABLE_FIELDS
+             ('dynobs', 5*N*p.max_dynobs)] #x,y,xrad,yrad,angle per stage per obstacle slot
+    layout, start = {}, 0
+    for key, size in sizes:
+        layout[key] = slice(start, start + size)
+        start += size
+    return layout
+
+def z_size(layout):
+    return max(block.stop for block in layout.values())
+
+def static_block(p : Parameters):
+    #Name and size of the static obstacle block of z for the chosen obstacle model
+    if p.obs_model == 'segments':
+        return ('segs', 4*p.max_seg) #ax,ay,bx,by per wall segment
+    return ('verts', 2*p.max_vert) #x,y per vertex circle
+
+def build_problem(p : Parameters):
     #Parameters
     no_x,no_u,N,dt = p.n_states, p.n_cmds, p.N_hor, p.dt
-    no_dynobs = p.n_dynobs
+    no_dynobs = p.max_dynobs #unused slots are parked at PAD_VERT by the packer
     dynparams = 5 #x,y, xrad,yrad, angle
     dyn_obs = dynparams*N #params per obstacle over horizon
     dyn_tot = dyn_obs*no_dynobs #params for all dynobs over horizon
 
-    # Define optimization variables
-    u = ca.SX.sym('u', no_u*N)  # 2 commands for each time step (v, omega)
-    z = ca.SX.sym('x',no_x + no_u + no_x*(N+1) + 2*p.max_vert + 1 + dyn_tot) # vector with x0, u_prev for rate limits, ref state vector along tajectory, stat and dyn obs
-    x0 = z[0:3] #initial state
-    u_prev = z[3:5] #Previous command v & w
-    ref = ca.reshape(z[5:5 + (N+1)*no_x],no_x,N+1) #ref traj with final pos and heading in 3D
+    # Define optimization variables, v and w scaled to [-1,1] by their (runtime) bounds
+    s = ca.SX.sym('s', no_u*N)  # 2 commands for each time step (v, omega)
+    layout = param_layout(p)
+    z = ca.SX.sym('x',z_size(layout)) # vector with x0, u_prev for rate limits, ref state vector along tajectory, stat and dyn obs
+    x0 = z[layout['x0']] #initial state
+    u_prev = z[layout['u_prev']] #Previous command v & w
+    ref = ca.reshape(z[layout['ref']],p.n_ref,N+1) #ref x,y,heading,v per stage
     
     #Static obstacle defintions
-    max_vert = p.max_vert
-    verts_flat_start = 5 + (N+1)*no_x
-    verts_flat_end = verts_flat_start+2*max_vert
-    verts_flat = z[verts_flat_start:verts_flat_end] #flat
-    verts = ca.reshape(verts_flat,max_vert,2)
-    r_safe = z[verts_flat_end]
+    if p.obs_model == 'segments':
+        segs = ca.reshape(z[layout['segs']],4,p.max_seg).T #z holds ax,ay,bx,by per segment, casadi reshapes column major
+    else:
+        max_vert = p.max_vert
+        verts_flat = z[layout['verts']] #flat
+        verts = ca.reshape(verts_flat,2,max_vert).T #z holds x0,y0,x1,y1.. and casadi reshapes column major
+    r_safe = z[layout['r_safe']]
     ob_terms = []
 
     #Dynamic obstacles
-    base = verts_flat_end + 1
-    end_dynobs = base + dyn_tot
-
-    #Initialize weights
-    Q = ca.diag(ca.SX([p.pos_dev, p.pos_dev, p.heading_dev]))  # State deviation weights
-    R = ca.diag(ca.SX([p.lin_vel_pen, p.ang_vel_pen]))  # Control effort weights
-    Ra = ca.diag(ca.SX([p.lin_acc_pen, p.ang_acc_pen]))  # Acc change weights
-    QN = ca.diag(ca.SX([p.termcost_pos, p.termcost_pos, p.termcost_heading]))  # Terminal state weights
+    base = layout['dynobs'].start
+    end_dynobs = layout['dynobs'].stop
+
+    #Initialize weights, read from z so one build serves every tuning
+    tun = {name: z[layout['tunables'].start + k] for k, name in enumerate(TUNABLE_FIELDS)}
+    Q = ca.diag(ca.vertcat(tun['pos_dev'], tun['pos_dev'], tun['heading_dev']))  # State deviation weights
+    R = ca.diag(ca.vertcat(tun['lin_vel_pen'], tun['ang_vel_pen']))  # Control effort weights
+    Ra = ca.diag(ca.vertcat(tun['lin_acc_pen'], tun['ang_acc_pen']))  # Acc change weights
+    QN = ca.diag(ca.vertcat(tun['termcost_pos'], tun['termcost_pos'], tun['termcost_heading']))  # Terminal state weights
     
-    v_seq = u[0::2] #every second element starting from 0
-    w_seq = u[1::2] #every second element starting from 1
+    #v = mid + half*s keeps the velocity bounds hard (a box on s) while they stay in z
+    v_seq = 0.5*(tun['vel_max'] + tun['vel_min']) + 0.5*(tun['vel_max'] - tun['vel_min'])*s[0::2]
+    w_seq = 0.5*(tun['ang_vel_max'] + tun['ang_vel_min']) + 0.5*(tun['ang_vel_max'] - tun['ang_vel_min'])*s[1::2]
 
     x = ca.SX(x0) #Current state
     J = 0 #Cost function
@@ -85,13 +133,24 @@ def open_solver(p : Parameters,build_dir="build_dir", name="nmpc_open"):
         
         '''
         
-        for j in range(max_vert):
-            vx,vy = verts[j,0], verts[j,1] #center of circle
-            dx = x[0] - vx
-            dy = x[1] - vy
-            dist = r_safe**2 - (dx**2 + dy**2)
-            ob_terms.append(dist) 
-            #J += w_obs *ca.fmax(0,dist)
+        if p.obs_model == 'segments':
+            for j in range(p.max_seg):
+                ax,ay = segs[j,0], segs[j,1]
+                abx,aby = segs[j,2] - ax, segs[j,3] - ay
+                #closest point on the segment, eps keeps padded zero length segments finite
+                t = ((x[0]-ax)*abx + (x[1]-ay)*aby) / (abx**2 + aby**2 + 1e-9)
+                t = ca.fmin(ca.fmax(t, 0), 1)
+                dx = x[0] - (ax + t*abx)
+                dy = x[1] - (ay + t*aby)
+                ob_terms.append(r_safe**2 - (dx**2 + dy**2))
+        else:
+            for j in range(max_vert):
+                vx,vy = verts[j,0], verts[j,1] #center of circle
+                dx = x[0] - vx
+                dy = x[1] - vy
+                dist = r_safe**2 - (dx**2 + dy**2)
+                ob_terms.append(dist) 
+                #J += w_obs *ca.fmax(0,dist)
         
         #Dynamic obstacle constraints
         #Assigned space to the 5 timeparameters, has same amount of elements as there are obstacles
@@ -109,12 +168,12 @@ def open_solver(p : Parameters,build_dir="build_dir", name="nmpc_open"):
             ob_terms.append(in_ellipse[k])
         
         #Optional: Trying to add a soft constraint on dynamic obstacles
-        m_soft = 0.50
+        m_soft = tun['m_soft']
         xrad_soft = x_rad + m_soft
         yrad_soft = y_rad + m_soft
         in_ellipse_soft = in_ellipse = 1 - ((xdiff*ca.cos(angle) + ydiff*ca.sin(angle))**2) / (xrad_soft**2) - ((xdiff*ca.sin(angle)-ydiff*ca.cos(angle))**2) / (yrad_soft**2)
 
-        w_soft = 50
+        w_soft = tun['w_soft']
         J += w_soft * ca.sumsqr(ca.fmax(0,in_ellipse_soft))
 
         #Stage cost
@@ -122,6 +181,7 @@ def open_solver(p : Parameters,build_dir="build_dir", name="nmpc_open"):
         err = ca.vertcat(x[0]-xref[0], x[1]-xref[1], angle_wrapper(x[2]-xref[2]))
         u_curr = ca.vertcat(v_seq[i], w_seq[i])
         J += ca.mtimes([err.T, Q, err]) + ca.mtimes([u_curr.T, R, u_curr])
+        J += tun['vel_dev'] * (v_seq[i] - xref[3])**2 #track the speed profile
 
         #Dynamics
         x = dyn_prop(x, u_curr, p)
@@ -138,175 +198,614 @@ def open_solver(p : Parameters,build_dir="build_dir", name="nmpc_open"):
     err_N = ca.vertcat(x[0]-ref[0,N], x[1]-ref[1,N], angle_wrapper(x[2]-ref[2,N]))
     J += ca.mtimes([err_N.T, QN, err_N])
 
-    # Input constraints
-    umin = [p.vel_min, p.ang_vel_min]*N
-    umax = [p.vel_max, p.ang_vel_max]*N
-    vel_bounds = og.constraints.Rectangle(umin,umax)
-
-    # Augmented Lagrangian for acc constaints
-    acc = [dv0,dw0]
-    for k in range(1,N):
-        acc+= [(v_seq[k]-v_seq[k-1])/dt, (w_seq[k]-w_seq[k-1])/dt]
-    acc = ca.vertcat(*acc)
-
-    acc_min = [p.lin_acc_min, p.ang_acc_min]*N
-    acc_max = [p.lin_acc_max, p.ang_acc_max]*N
-    acc_bounds = og.constraints.Rectangle(acc_min, acc_max)
+    # Augmented Lagrangian for the acc constaints
+    # bounds live in z, so each row is scaled to [-1,1] as (val - mid)/half_width
+    def scaled(val, lo, hi):
+        return (val - 0.5*(hi + lo)) / ca.fmax(0.5*(hi - lo), 1e-9) #lo == hi pins val to lo
 
-    ob_set = og.constraints.Rectangle([-1e10]*int(ob_cntrs.size1()),[0.0]*int(ob_cntrs.size1())) #create set for each vertex
+    box = []
+    for k in range(N):
+        dv = dv0 if k == 0 else (v_seq[k]-v_seq[k-1])/dt
+        dw = dw0 if k == 0 else (w_seq[k]-w_seq[k-1])/dt
+        box += [scaled(dv, tun['lin_acc_min'], tun['lin_acc_max']),
+                scaled(dw, tun['ang_acc_min'], tun['ang_acc_max'])]
+    n_box = len(box)
 
+    # One mapping for all ALM constraints, opengen keeps only the last one it is given
+    f1 = ca.vertcat(*box, ob_cntrs)
+    n_ob = int(ob_cntrs.size1())
+    c_set = og.constraints.Rectangle([-1.0]*n_box + [-1e10]*n_ob, [1.0]*n_box + [0.0]*n_ob) #obstacle rows only bounded above
 
-    problem = og.builder.Problem(u,z,J) \
-        .with_constraints(vel_bounds) \
-        .with_aug_lagrangian_constraints(acc, acc_bounds) \
-        .with_aug_lagrangian_constraints(ob_cntrs,ob_set) 
 
-    build_cfg = og.config.BuildConfiguration() \
-        .with_build_directory(build_dir) \
-        .with_build_mode("release") \
-        .with_tcp_interface_config()
+    problem = og.builder.Problem(s,z,J) \
+        .with_constraints(og.constraints.Rectangle([-1.0]*no_u*N, [1.0]*no_u*N)) \
+        .with_aug_lagrangian_constraints(f1, c_set)
 
-    meta = og.config.OptimizerMeta().with_optimizer_name(name)
+    return problem
 
-    solver_config = og.config.SolverConfiguration() \
+def solver_configuration():
+    return og.config.SolverConfiguration() \
         .with_tolerance(1e-6) \
         .with_max_duration_micros(500_000) \
-        .with_initial_penalty(1e4) \
+        .with_initial_penalty(INITIAL_PENALTY) \
         .with_penalty_weight_update_factor(10.0)
-    
-        
+
+def build_configuration(python_bindings=False):
+    return og.config.BuildConfiguration() \
+        .with_build_mode("release") \
+        .with_tcp_interface_config() \
+        .with_build_python_bindings(python_bindings)
+
+def build_key(p : Parameters, solver_config, build_cfg):
+    '''
+    Hash of everything that ends up in the compiled optimizer: the problem shaping
+    Parameters fields, the order of TUNABLE_FIELDS, the source of the z layout and of
+    the cost/constraint construction, the solver and build config and the opengen version
+    '''
+    shape = {k: v for k, v in vars(p).items() if k not in _RUNTIME_FIELDS}
+    build = {k: v for k, v in build_cfg.to_dict().items() if k != 'build_directory'}
+    source = ''.join(inspect.getsource(f) for f in (param_layout, static_block, build_problem, dyn_prop,
+                                                     angle_wrapper))
+    blob = json.dumps({'params': shape,
+                       'tunables': list(TUNABLE_FIELDS), #their order is the layout of z['tunables']
+                       'solver': solver_config.to_dict(),
+                       'build': build,
+                       'source': source,
+                       'opengen': version('opengen')}, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+def cached_build(build_dir, name, key):
+    #A variant is reusable only if its build finished and wrote the stamp
+    stamp = os.path.join(build_dir, name, _BUILD_STAMP)
+    if not os.path.isfile(stamp):
+        return False
+    with open(stamp, 'r') as file:
+        return file.read().strip() == key
+
+def open_solver(p : Parameters,build_dir="build_dir", name="nmpc_open", rebuild=False, python_bindings=False,
+                verbose=True):
+    solver_config = solver_configuration()
+    build_cfg = build_configuration(python_bindings)
+
+    #One subdirectory per variant so e.g. several horizon lengths stay cached side by side
+    key = build_key(p, solver_config, build_cfg)
+    variant_dir = os.path.join(build_dir, key[:12])
+    if not rebuild and cached_build(variant_dir, name, key):
+        if verbose:
+            print(f'Reusing cached optimizer {variant_dir}/{name}')
+        return variant_dir, name
+
+    problem = build_problem(p)
+    build_cfg.with_build_directory(variant_dir)
+    meta = og.config.OptimizerMeta().with_optimizer_name(name)
     builder = og.builder.OpEnOptimizerBuilder(problem, meta, build_cfg, solver_config) \
-        .with_verbosity_level(1)
+        .with_verbosity_level(1 if verbose else logging.ERROR)
     
     builder.build()
-
-    return build_dir,name
-
-def start_manager(build_dir, name):
-    mng = og.tcp.OptimizerTcpManager(f'{build_dir}/{name}')
+    with open(os.path.join(variant_dir, name, _BUILD_STAMP), 'w') as file:
+        file.write(key)
+
+    return variant_dir,name
+
+class DirectSolver:
+    '''
+    Optimizer loaded in-process from the generated python bindings
+    Has the start/call/kill interface of og.tcp.OptimizerTcpManager so run_mpc works with either
+    '''
+    def __init__(self, build_dir, name):
+        ext = '.pyd' if sys.platform == 'win32' else '.so'
+        path = os.path.join(build_dir, name, name + ext)
+        spec = importlib.util.spec_from_file_location(name, path)
+        if spec is None or not os.path.isfile(path):
+            raise ImportError(f'No python bindings at {path}')
+        self.module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.module)
+        self.solver = None
+
+    def start(self):
+        self.solver = self.module.solver()
+
+    def kill(self):
+        self.solver = None
+
+    def call(self, p, initial_guess=None, initial_y=None, initial_penalty=None):
+        #bindings take plain lists, tolist is the cheapest conversion from numpy
+        p = np.asarray(p, dtype=np.float64).tolist()
+        if initial_guess is not None:
+            initial_guess = np.asarray(initial_guess, dtype=np.float64).tolist()
+        if initial_y is not None:
+            initial_y = np.asarray(initial_y, dtype=np.float64).tolist()
+        if initial_penalty is not None:
+            initial_penalty = float(initial_penalty)
+        return self.solver.run(p, initial_guess, initial_y, initial_penalty)
+
+def start_manager(build_dir, name, transport='tcp', port=None):
+    '''
+    transport: 'direct' loads the python bindings in-process, 'tcp' starts the TCP server
+    port: overrides the TCP port from optimizer.yml, e.g. to run several servers
+    Falls back to TCP if the bindings are not available
+    '''
+    if transport == 'direct':
+        try:
+            mng = DirectSolver(build_dir, name)
+            mng.start()
+            return mng
+        except ImportError as e:
+            print(f'{e}, falling back to TCP')
+    mng = og.tcp.OptimizerTcpManager(f'{build_dir}/{name}', port=port)
     mng.start()
     return mng
 
+def static_obstacle_index(p : Parameters):
+    #Map preprocessing for the static obstacle block, built once per map
+    if p.obs_model == 'segments':
+        return path_planning.SegmentIndex(path_planning.obstacle_segments(p.obstacles, p.boundaries))
+    return path_planning.SpatialGrid(np.vstack([np.asarray(h, dtype=np.float64) for h in p.obstacles]))
+
+def select_threats(states, path_xy, k, danger):
+    '''
+    Indices of the k most threatening obstacles
+    states: (M,N,5) predicted obstacle states, path_xy: (N,2) planned positions per stage
+    Obstacles whose closest approach to the plan (minus their larger radius) is below
+    danger come first, earliest time to closest approach first, the rest by distance
+    '''
+    gap = np.linalg.norm(states[:,:,:2] - path_xy[None], axis=2) - states[:,:,2:4].max(axis=2)
+    t_ca = gap.argmin(axis=1)
+    d_ca = gap[np.arange(len(gap)), t_ca]
+    close = d_ca < danger
+    return np.lexsort((np.where(close, t_ca, d_ca), ~close))[:k]
+
+class ParamPacker:
+    '''
+    Owns a single preallocated z buffer laid out by param_layout
+    r_safe and the tunables are written once, pack() only overwrites x0, u_prev, the reference
+    window, the selected static primitives and the dynamic obstacle states in place
+    episode_steps: length of the time grid the dynamic obstacle motion is precomputed on
+    '''
+    def __init__(self, p : Parameters, static_index=None, episode_steps=0):
+        N = p.N_hor
+        self.p = p
+        self.layout = param_layout(p)
+        self.z = np.zeros(z_size(self.layout), dtype=np.float64)
+
+        #Static obstacles, the primitives closest to what the horizon can reach are picked per step
+        if static_index is None:
+            static_index = static_obstacle_index(p)
+        self.static_index = static_index
+        if p.obs_model == 'segments':
+            self.static_items = static_index.segs
+            self.static = self.z[self.layout['segs']].reshape(p.max_seg, 4) #view into z
+        else:
+            self.static_items = static_index.points
+            self.static = self.z[self.layout['verts']].reshape(p.max_vert, 2) #view into z
+        self.reach = p.vel_max*p.N_hor*p.dt + p.r_safe
+        self.set_tunables(p)
+
+        #Dynamic obstacles, table of M obstacles, episode_steps > 0 precomputes their motion
+        #the max_dynobs most threatening ones fill the slots, the rest of the slots stay far away
+        self.dynobs = path_planning.DynObsTable(p.dynobs, dt=p.dt, steps=episode_steps + N)
+        self.dyn = self.z[self.layout['dynobs']].reshape(p.max_dynobs, N, 5) #view into z
+        self.dyn[:] = (PAD_VERT, PAD_VERT, 1.0, 1.0, 0.0)
+        self.danger = p.r_safe + p.m_soft
+        self.selected = np.arange(min(len(self.dynobs), p.max_dynobs))
+
+    def set_tunables(self, p : Parameters):
+        #Weights, bounds and r_safe can change between runs without a rebuild
+        self.z[self.layout['r_safe']] = p.r_safe
+        self.z[self.layout['tunables']] = [getattr(p, name) for name in TUNABLE_FIELDS]
+
+    def pack(self, x0, u_prev, xref, t_curr, others=None): #xref is N+1,n_ref
+        #others: (K,N,5) predicted states of further obstacles (e.g. other robots), they
+        #compete with the scripted ones for the slots
+        z, layout = self.z, self.layout
+        z[layout['x0']] = x0
+        z[layout['u_prev']] = u_prev
+        z[layout['ref']] = np.ravel(xref)
+
+        near = self.static_index.nearest(np.asarray(x0[:2], dtype=np.float64), self.reach, len(self.static))
+        self.static[:len(near)] = self.static_items[near]
+        self.static[len(near):] = PAD_VERT #fake distances for empty entries
+
+        states = self.dynobs.window(t_curr, self.p.N_hor)
+        if others is not None and len(others):
+            states = np.concatenate([states, others])
+        if len(states) > len(self.dyn):
+            self.selected = select_threats(states, xref[:self.p.N_hor,:2], len(self.dyn), self.danger)
+            states = states[self.selected]
+        else:
+            self.selected = np.arange(len(states))
+        self.dyn[:len(states)] = states
+        self.dyn[len(states):] = (PAD_VERT, PAD_VERT, 1.0, 1.0, 0.0)
+        return z
+
 def pack_params(x0, u_prev, xref,p: Parameters,t_curr): #Xref is N+1,3
-    dt = p.dt
-    N = p.N_hor
-    stat_v = np.vstack([np.asarray(h, dtype=np.float64) for h in p.obstacles])
-    svlen = min(len(stat_v), p.max_vert)
-    padded = np.zeros((p.max_vert,2), dtype=np.float64) #initialize vert matrix
-    if svlen > 0:
-        padded[:svlen,:] = stat_v[:svlen,:] # populating matrix
-    if svlen < p.max_vert:
-        padded[svlen:,:] = 1e3 #fake distances for the rest of the empty entries
-    
-    verts_flat = padded.reshape(-1) #2*max_vert array
-    
-    #dynamic obstacles
-    dynobs_list = p.dynobs
-    n_dynobs = p.n_dynobs
-    time = t_curr + dt*np.arange(N)
-    dyn_pobs = [] #block per obstacle Nx5
-    for (p1,p2,freq,xrad,yrad,angle) in dynobs_list:
-        xs = np.empty(N,dtype=np.float64)
-        ys = np.empty(N,dtype=np.float64)
-        for k,t in enumerate(time):
-            x,y = path_planning.gen_dynamic_obstacle(p1,p2,freq,t)
-            xs[k],ys[k] = x,y
-        block = np.column_stack([xs,ys,
-                                 np.full(N,xrad,dtype=np.float64),
-                                 np.full(N,yrad,dtype=np.float64),
-                                 np.full(N,angle,dtype=np.float64)])
-        dyn_pobs.append(block.reshape(-1))
-
-    dyn_flat = np.concatenate(dyn_pobs) if dyn_pobs else np.array([],dtype=np.float64)
-
-    return np.concatenate([
-        np.asarray(x0, dtype=np.float64),
-        np.asarray(u_prev, dtype=np.float64),
-        np.asarray(xref, dtype=np.float64).reshape(-1),
-        verts_flat,
-        np.asarray([p.r_safe],dtype=np.float64),
-        dyn_flat
-    ])
-
-def run_mpc(p,ref_trajectory):
-    build_dir, name = open_solver(p)
+    #One-off packing, loops should keep a ParamPacker around instead
+    return ParamPacker(p).pack(x0, u_prev, xref, t_curr)
+
+def shift_solution(u_opt, n_cmds):
+    #Drop the applied stage and repeat the last one so the guess covers the next horizon
+    u_opt = np.asarray(u_opt, dtype=np.float64)
+    return np.concatenate([u_opt[n_cmds:], u_opt[-n_cmds:]])
+
+def shift_blocks(vec, blocks):
+    #blocks: (length, stage size) in order, each block drops its first stage and repeats its last
+    out = np.empty_like(vec)
+    start = 0
+    for length, stage in blocks:
+        block = vec[start:start + length]
+        out[start:start + length - stage] = block[stage:]
+        out[start + length - stage:start + length] = block[length - stage:]
+        start += length
+    return out
+
+_evaluators = {} #build key -> (casadi evaluator of cost and f1, f1 lower bounds, f1 upper bounds)
+
+class Controller:
+    '''
+    Interface of the MPC backends driven by closed_loop
+    build(): compile / start what the backend needs, returns self
+    reset(episode_steps): new episode, new ParamPacker, drops the warm start state
+    solve(x, u_prev, ref, t, others=None): control sequence for state x, previous command u_prev,
+        reference window ref (N+1, n_ref) and time t, obstacles come from p (static), p.dynobs
+        at t and the optional predicted states others (K,N,5), see ParamPacker.pack
+    diagnostics(): dict of the last solve, keys are telemetry columns
+    close(): stops the backend
+    Every backend solves build_problem(p), objective and violation in the diagnostics are
+    evaluated on that same problem so the numbers are comparable across backends
+    Solvers work on the scaled commands s (see build_problem), solve() returns v,w
+    '''
+    def __init__(self, p : Parameters):
+        self.p = p
+        self.packer = None
+        self.diag = {}
+
+    def build(self):
+        key = build_key(self.p, solver_configuration(), build_configuration())
+        if key not in _evaluators:
+            problem = build_problem(self.p)
+            evaluate = ca.Function('evaluate', [problem.decision_variables, problem.parameter_variables],
+                                   [problem.cost_function, problem.penalty_mapping_f1])
+            _evaluators[key] = (evaluate, np.array(problem.alm_set_c.xmin), np.array(problem.alm_set_c.xmax))
+        self.evaluate, self.f1_min, self.f1_max = _evaluators[key]
+        n_acc, N = 2*self.p.N_hor, self.p.N_hor #dv, dw rows per stage, then the obstacle rows per stage
+        self.f1_blocks = [(n_acc, 2), (len(self.f1_max) - n_acc, (len(self.f1_max) - n_acc)//N)]
+        return self
+
+    def reset(self, episode_steps=0):
+        self.packer = ParamPacker(self.p, episode_steps=episode_steps)
+
+    def score(self, s, z):
+        #objective and largest constraint violation of the scaled solution s on the shared problem
+        J, f1 = self.evaluate(s, z)
+        f1 = np.asarray(f1).ravel()
+        violation = max(0.0, float(np.max(f1 - self.f1_max)), float(np.max(self.f1_min - f1)))
+        return float(J), violation
+
+    def solve(self, x, u_prev, ref, t, others=None):
+        raise NotImplementedError
+
+    def diagnostics(self):
+        return self.diag
+
+    def close(self):
+        pass
+
+class OpEnController(Controller):
+    '''
+    OpEn backend, a TCP server or the in-process bindings (see start_manager)
+    mng: an already running manager, it is then left running by close()
+    owns_mng: close() kills the manager, defaults to True only when build() starts it
+    warm_start: seed each solve with the shifted previous solution, multipliers and penalty
+    compare_cold: additionally solve every step cold with the same z to measure the gain
+    '''
+    def __init__(self, p : Parameters, transport='tcp', warm_start=True, compare_cold=False, mng=None,
+                 verbose=False, owns_mng=None):
+        super().__init__(p)
+        self.transport, self.warm_start, self.compare_cold = transport, warm_start, compare_cold
+        self.verbose = verbose
+        self.mng, self.owns_mng = mng, mng is None if owns_mng is None else owns_mng
+
+    def build(self):
+        super().build()
+        if self.mng is None:
+            build_dir, name = open_solver(self.p, python_bindings=(self.transport == 'direct'),
+                                          verbose=self.verbose)
+            self.mng = start_manager(build_dir, name, self.transport)
+        return self
+
+    def reset(self, episode_steps=0):
+        super().reset(episode_steps)
+        self.guess, self.y_prev, self.penalty_prev = None, None, None
+
+    def solve(self, x, u_prev, ref, t, others=None):
+        t0 = time.perf_counter()
+        z = self.packer.pack(x, u_prev, ref, t, others)
+        t1 = time.perf_counter()
+        if self.warm_start and self.guess is not None:
+            sol = self.mng.call(z, initial_guess=self.guess, initial_y=self.y_prev,
+                                initial_penalty=self.penalty_prev)
+        else:
+            sol = self.mng.call(z)
+        t2 = time.perf_counter()
+        if not sol.is_ok():
+            raise RuntimeError(f"Solver failed {sol.get().message}")
+        status = sol.get()
+        s_opt = np.asarray(status.solution, dtype=np.float64)
+        objective, violation = self.score(s_opt, z)
+        self.diag = {'t_pack_ms': 1e3*(t1-t0), 't_solve_ms': 1e3*(t2-t1),
+                     'solve_time_ms': status.solve_time_ms,
+                     'inner_iters': status.num_inner_iterations,
+                     'outer_iters': status.num_outer_iterations,
+                     'penalty': status.penalty,
+                     'f1_infeasibility': status.f1_infeasibility,
+                     'f2_norm': status.f2_norm,
+                     'cost': status.cost,
+                     'objective': objective, 'violation': violation,
+                     'converged': float(getattr(status, 'exit_status', 'Converged') == 'Converged')}
+        if self.compare_cold:
+            cold = self.mng.call(z)
+            if cold.is_ok():
+                self.diag.update(cold_solve_time_ms=cold.get().solve_time_ms,
+                                 cold_inner_iters=cold.get().num_inner_iterations)
+        self.guess = shift_solution(s_opt, self.p.n_cmds)
+        #multipliers stage aligned with the shifted guess, like IpoptController's lam_g,
+        #dropped if they do not match the f1 layout
+        y = np.asarray(status.lagrange_multipliers or [], dtype=np.float64)
+        self.y_prev = shift_blocks(y, self.f1_blocks).tolist() if len(y) == len(self.f1_max) else None
+        #OpEn only ever raises the penalty, carried over uncapped it ratchets up step after
+        #step and makes every later subproblem stiffer
+        self.penalty_prev = min(status.penalty, 10*INITIAL_PENALTY)
+        return unscale_commands(s_opt, self.p)
+
+    def close(self):
+        if self.owns_mng and self.mng is not None:
+            self.mng.kill() # stop rust
+            self.mng = None
+
+class IpoptController(Controller):
+    '''
+    IPOPT backend on the same build_problem cost, s box and f1 constraints, as an NLP in s only
+    (the dynamics are rolled out inside the cost like in the OpEn problem)
+    warm_start: start from the shifted previous solution and constraint multipliers
+    jit: compile the NLP functions to C first (needs a C compiler)
+    '''
+    def __init__(self, p : Parameters, warm_start=True, jit=False, max_iter=200, tol=1e-6):
+        super().__init__(p)
+        self.warm_start, self.jit, self.max_iter, self.tol = warm_start, jit, max_iter, tol
+
+    def build(self):
+        super().build()
+        problem = build_problem(self.p)
+        f1 = problem.penalty_mapping_f1
+        nlp = {'x': problem.decision_variables, 'p': problem.parameter_variables,
+               'f': problem.cost_function, 'g': f1}
+        opts = {'ipopt': {'print_level': 0, 'max_iter': self.max_iter, 'tol': self.tol},
+                'print_time': False}
+        if self.warm_start:
+            opts['ipopt'].update({'warm_start_init_point': 'yes', 'warm_start_bound_push': 1e-6,
+                                  'warm_start_mult_bound_push': 1e-6, 'mu_init': 1e-4})
+        if self.jit:
+            opts.update({'jit': True, 'compiler': 'shell', 'jit_options': {'flags': ['-O1'], 'verbose': False}})
+        self.solver = ca.nlpsol('mpc_ipopt', 'ipopt', nlp, opts)
+        self.lbg = np.where(self.f1_min <= -1e9, -np.inf, self.f1_min) #obstacle rows are only bounded above
+        self.ubg = self.f1_max
+        self.lbx, self.ubx = np.array(problem.constraints.xmin), np.array(problem.constraints.xmax)
+        return self
+
+    def reset(self, episode_steps=0):
+        super().reset(episode_steps)
+        self.guess, self.lam_g = None, None
+
+    def solve(self, x, u_prev, ref, t, others=None):
+        t0 = time.perf_counter()
+        z = self.packer.pack(x, u_prev, ref, t, others)
+        t1 = time.perf_counter()
+        guess = np.zeros(self.p.n_cmds*self.p.N_hor) if self.guess is None else self.guess
+        warm = {'lam_g0': self.lam_g} if self.warm_start and self.lam_g is not None else {}
+        sol = self.solver(x0=guess, p=z, lbx=self.lbx, ubx=self.ubx, lbg=self.lbg, ubg=self.ubg, **warm)
+        t2 = time.perf_counter()
+        stats = self.solver.stats()
+        s_opt = sol['x'].full().ravel()
+        objective, violation = self.score(s_opt, z)
+        self.diag = {'t_pack_ms': 1e3*(t1-t0), 't_solve_ms': 1e3*(t2-t1),
+                     'solve_time_ms': 1e3*(t2-t1),
+                     'inner_iters': stats['iter_count'],
+                     'cost': float(sol['f']),
+                     'objective': objective, 'violation': violation,
+                     'converged': float(stats['success'])}
+        if self.warm_start:
+            self.guess = shift_solution(s_opt, self.p.n_cmds)
+            self.lam_g = shift_blocks(sol['lam_g'].full().ravel(), self.f1_blocks)
+        return unscale_commands(s_opt, self.p)
+
+class ShadowController(Controller):
+    '''
+    Drives the loop with primary and solves every step again with shadow on the
+    same inputs, gap = (primary - shadow objective) / |shadow objective|
+    '''
+    def __init__(self, primary : Controller, shadow : Controller):
+        super().__init__(primary.p)
+        self.primary, self.shadow = primary, shadow
+
+    def build(self):
+        self.primary.build()
+        self.shadow.build()
+        return self
+
+    def reset(self, episode_steps=0):
+        self.primary.reset(episode_steps)
+        self.shadow.reset(episode_steps)
+        self.packer = self.primary.packer
+
+    def solve(self, x, u_prev, ref, t, others=None):
+        u_opt = self.primary.solve(x, u_prev, ref, t, others)
+        self.shadow.solve(x, u_prev, ref, t, others)
+        prim, shad = self.primary.diag, self.shadow.diag
+        self.diag = dict(prim)
+        self.diag.update(shadow_solve_time_ms=shad['solve_time_ms'],
+                         shadow_objective=shad['objective'],
+                         shadow_violation=shad['violation'],
+                         gap=(prim['objective'] - shad['objective'])/max(abs(shad['objective']), 1e-9))
+        return u_opt
+
+    def close(self):
+        self.primary.close()
+        self.shadow.close()
+
+def closed_loop(p, ref_trajectory, controller, verbose=True, replanner=None, max_steps=None, sdf=None):
+    '''
+    Simulates the closed loop with any Controller backend (built, not yet reset)
+    verbose: print per step diagnostics
+    replanner: replanning.Replanner, may swap the reference from the current step on
+    max_steps: step budget, defaults to 1.25x the reference duration (twice that with a replanner)
+    sdf: path_planning.SignedDistanceField of the map for the clearance column, defaults to
+         the one cached per map by path_planning.signed_distance_field
+    returns sim_traj, commands and the per step Telemetry
+    '''
     obstacles = p.obstacles
-    mng = start_manager(build_dir, name)
-    print(f'No of waypoints {ref_trajectory.shape}')
-    x = ref_trajectory[0] # Initial state
+    if verbose:
+        print(f'No of waypoints {ref_trajectory.shape}')
+    x = ref_trajectory[0, :p.n_states].copy() # Initial state
     u_prev = np.array([0.0, 0.0]) # Initial previous command
-    sim_time = len(ref_trajectory)*p.dt # Simulation time
+    sim_time = 1.25*len(ref_trajectory)*p.dt # Simulation time, slack for lagging behind the profile
     #x_end = ref_trajectory[-1]
     #end_thres = 0.25
     
     steps = int(sim_time / p.dt)
+    if max_steps is not None:
+        steps = max_steps
+    elif replanner is not None:
+        steps = 2*steps #a replanned reference is usually longer than the original
     states = np.zeros((steps, p.n_states))
     commands = np.zeros((steps, p.n_cmds))
     sim_traj = [x]
     crash_test = []
+    controller.reset(episode_steps=steps + 3) #+3 covers t_lead
+    packer = controller.packer
+    layout = packer.layout
+    if sdf is None:
+        sdf = path_planning.signed_distance_field(obstacles, p.boundaries)
+    tel = Telemetry(steps)
+
+    tracker = path_planning.RefTracker(ref_trajectory)
 
     for i in range(steps):
-        #Segment based on current position
-        end = min(i + p.N_hor, ref_trajectory.shape[0]-1)
-        seg = ref_trajectory[i:end+1,:]
-        if seg.shape[0] < p.N_hor + 1:
-            # Pad with last state
-            seg = np.vstack([seg,np.repeat(seg[-1][None,:],p.N_hor + 1 - seg.shape[0],axis=0)])
-        static_vertices = np.vstack([np.asarray(hole,dtype=np.float64) for hole in obstacles])
+        #Reference window from the robot's progress along the path, not from i
+        t_ref = time.perf_counter()
+        seg = tracker.window(x, p.N_hor + 1)
+        if replanner is not None:
+            reason = replanner.check(i, x, tracker.dist)
+            if reason is not None:
+                t_rp = time.perf_counter()
+                ref_trajectory = replanner.replan(p, i, x, ref_trajectory, reason, v0=max(u_prev[0], 0.0))
+                tracker = path_planning.RefTracker(ref_trajectory)
+                seg = tracker.window(x, p.N_hor + 1)
+                tel.record(i, t_replan_ms=1e3*(time.perf_counter()-t_rp))
+                if verbose:
+                    print(f'Step {i} replanned ({reason})')
+        tel.record(i, t_ref_ms=1e3*(time.perf_counter()-t_ref), path_dev=tracker.dist)
         t_lead = 2.0 * p.dt #pretend obstacle is further ahead than actual
         t_curr = i*p.dt + t_lead
-        z = pack_params(x, u_prev, seg,p,t_curr) # z for solver
 
-        sol = mng.call(z)
-        if not sol.is_ok():
-            mng.kill() # stop rust
-            raise RuntimeError(f"Solver failed {sol.get().message}")
+        u_opt = controller.solve(x, u_prev, seg, t_curr) #best control sequence
+        diag = controller.diagnostics()
+        tel.record(i, **{key: value for key, value in diag.items() if key in tel.data})
         
-        # decode the exact centers you enforced this step
-        vstart = 5 + (p.N_hor+1)*p.n_states
-        vend   = vstart + 2*p.max_vert
-        verts_used = z[vstart:vend].reshape(p.max_vert, 2)
-        r_enf = float(z[vend])          # 0.75 if you passed that
+        t3 = time.perf_counter()
+        # decode the exact primitives you enforced this step
+        static_used = packer.static[packer.static[:,0] < PAD_VERT] # skip padded sentinels
+        r_enf = float(packer.z[layout['r_safe']][0])          # 0.75 if you passed that
 
         # current executed node (what you plot)
         p_now = np.asarray(x[:2], float)
 
-        # 1) distance to the ENFORCED centers
-        mask = verts_used[:,0] < 1e8    # skip padded sentinels
-        if mask.any():
-            d_enf = np.linalg.norm(verts_used[mask] - p_now, axis=1)
-            d_enf_min = float(d_enf.min())
-        else:
+        # 1) distance to the ENFORCED primitives
+        if len(static_used) == 0:
             d_enf_min = np.inf
+        elif p.obs_model == 'segments':
+            d_enf_min = float(path_planning.segment_distances(p_now, static_used).min())
+        else:
+            d_enf_min = float(np.linalg.norm(static_used - p_now, axis=1).min())
 
-        # 2) distance to ALL plotted centers (all map vertices)
-        all_verts = np.vstack([np.asarray(h, float) for h in obstacles])
-        d_plot = np.linalg.norm(all_verts - p_now, axis=1)
-        d_plot_min = float(d_plot.min())
+        # 2) clearance to the real walls, negative inside an obstacle
+        clearance = float(sdf(p_now)[0])
         crash_test.append(d_enf_min)
 
-        print(
-            f"d_enforced_min={d_enf_min:.3f}, r_enforced={r_enf:.3f}, "
-            f"d_plot_min={d_plot_min:.3f}, r_plot=0.500"
-        )
-        
-        print(f'Step {i} Solver Success, cost is {sol.get().cost}, time spent is {sol.get().solve_time_ms} ms')
-        u_opt = sol.get().solution #best control sequence
+        # 3) distance to the dynamic obstacle centers the solver saw at stage 0
+        dyn_now = packer.dyn[:len(packer.selected),0,:2] #active slots only
+        dyn_dist_min = float(np.linalg.norm(dyn_now - p_now, axis=1).min()) if len(dyn_now) else np.inf
+        tel.record(i, clearance=clearance, d_enforced_min=d_enf_min, dyn_dist_min=dyn_dist_min,
+                   t_diag_ms=1e3*(time.perf_counter()-t3))
+
+        if verbose:
+            print(
+                f"d_enforced_min={d_enf_min:.3f}, r_enforced={r_enf:.3f}, "
+                f"clearance={clearance:.3f}"
+            )
+            
+            cold_info = ''
+            if 'cold_solve_time_ms' in diag:
+                cold_info = f', cold {diag["cold_solve_time_ms"]} ms / {diag["cold_inner_iters"]:.0f} iters'
+            print(f'Step {i} Solver Success, cost is {diag["cost"]}, time spent is {diag["solve_time_ms"]} ms, '
+                  f'{diag["inner_iters"]} inner iters{cold_info}')
         vcurr,wcurr = float(u_opt[0]), float(u_opt[1]) #first command
         u_prev = np.array([vcurr,wcurr])
 
         #Apply first command
+        t4 = time.perf_counter()
         x = dyn_prop_np(x, u_prev, p).flatten()
+        tel.record(i, t_dyn_ms=1e3*(time.perf_counter()-t4))
         states[i,:] = x
         commands[i,:] = u_prev
         sim_traj.append(x)
 
-    mng.kill() # stop rust
-    print("Done. Collected", len(sim_traj), "states.")
+    commands = commands[:tel.n]
+    if verbose:
+        print("Done. Collected", len(sim_traj), "states.")
 
 
     # for element in crash_test:
     #     if element < 0.5:
     #         print(f'crashed at {element}')
 
-    return sim_traj, commands
\ No newline at end of file
+    return sim_traj, commands, tel
+
+def report_solve_stats(tel):
+    t, it = tel['solve_time_ms'], tel['inner_iters']
+    print(f'Solve time mean {np.nanmean(t):.2f} ms, max {np.nanmax(t):.2f} ms, '
+          f'inner iters mean {np.nanmean(it):.1f}, max {np.nanmax(it):.0f}')
+    if not np.all(np.isnan(tel['cold_solve_time_ms'])):
+        dt_ms = tel['cold_solve_time_ms'] - t
+        dit = tel['cold_inner_iters'] - it
+        print(f'Warm start saves {np.nanmean(dt_ms):.2f} ms (max {np.nanmax(dt_ms):.2f} ms) '
+              f'and {np.nanmean(dit):.1f} inner iters per step')
+
+def make_controller(p : Parameters, backend='open', transport='tcp', warm_start=True, compare_cold=False,
+                    verbose=False):
+    #backend: 'open' (transport 'tcp' or 'direct') or 'ipopt', not built yet
+    if backend == 'ipopt':
+        return IpoptController(p, warm_start=warm_start)
+    if backend == 'open':
+        return OpEnController(p, transport, warm_start, compare_cold, verbose=verbose)
+    raise ValueError(f'Unknown backend {backend}, expected open or ipopt')
+
+def run_mpc(p,ref_trajectory, warm_start=False, compare_cold=False, transport='tcp',
+            verbose=True, telemetry_path=None, replanner=None, backend='open'):
+    '''
+    Builds (or reuses) the optimizer, runs the closed loop and stops the solver
+    backend: 'open' (transport 'tcp' or 'direct') or 'ipopt'
+    telemetry_path: if given, the per step telemetry is written there as .npz
+    '''
+    controller = make_controller(p, backend, transport, warm_start, compare_cold, verbose).build()
+    try:
+        sim_traj, commands, tel = closed_loop(p, ref_trajectory, controller, verbose, replanner)
+    finally:
+        controller.close()
+    if telemetry_path is not None:
+        tel.save(telemetry_path)
+    if verbose:
+        report_solve_stats(tel)
+        if replanner is not None:
+            replanner.summary()
+
+    return sim_traj, commands
@@ -0,0 +1,216 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import path_planning
+from parameters import Parameters
+import mpcopEn
+import scenario
+from mpcopEn import dyn_prop_np
+from realtime import brake_command
+from telemetry import Telemetry
+
+#Per step log of MultiAgentSim, per agent solve times are kept separately
+MA_COLUMNS = ('t_step_ms', #wall time of all solves of the step (they run concurrently)
+              't_solve_max_ms', 't_solve_mean_ms', #per agent solve wall times
+              't_exchange_ms', #propagating the plants and rolling out the predictions
+              'active', #agents not at their goal yet
+              'failures', #agents whose solve raised, they brake this step
+              'min_sep') #closest pair of agents after the step
+
+
+class Agent:
+    '''
+    One robot: its reference, solver and state
+    prediction: (N,2) positions its last solution leads to, what the other agents see
+    '''
+    def __init__(self, name, ref_trajectory, controller : mpcopEn.Controller, p : Parameters):
+        self.name = name
+        self.ref = ref_trajectory
+        self.controller = controller
+        self.x = ref_trajectory[0, :p.n_states].copy()
+        self.u_prev = np.zeros(p.n_cmds)
+        self.u_seq = None
+        self.tracker = path_planning.RefTracker(ref_trajectory)
+        self.prediction = np.repeat(self.x[None, :2], p.N_hor, axis=0) #nothing solved yet, assume it stays
+        self.done = False
+        self.traj = [self.x.copy()]
+
+def rollout(x, u_seq, p : Parameters):
+    #(N,2) positions after each stage of u_seq, same model as the plant
+    pos = np.empty((p.N_hor, 2))
+    u_seq = np.asarray(u_seq, dtype=np.float64).reshape(p.N_hor, p.n_cmds)
+    for k in range(p.N_hor):
+        x = dyn_prop_np(x, u_seq[k], p).flatten()
+        pos[k] = x[:2]
+    return pos
+
+def random_agents(planner : path_planning.PathPlanner, n, seed=0, min_sep=2.0, min_dist=15.0):
+    '''
+    n (start, goal) pairs inside the free space of planner's map, starts and goals at
+    least min_sep apart from each other and every goal at least min_dist from its start
+    '''
+    rng = np.random.default_rng(seed)
+    boundary = np.asarray(planner.environment.boundary_polygon)
+    lo, hi = boundary.min(axis=0), boundary.max(axis=0)
+    starts, goals = [], []
+    for _ in range(10000*n):
+        if len(starts) == n:
+            break
+        s, g = rng.uniform(lo, hi), rng.uniform(lo, hi)
+        if np.linalg.norm(g - s) < min_dist:
+            continue
+        if not (planner.environment.within_map(s) and planner.environment.within_map(g)):
+            continue
+        if any(np.linalg.norm(s - o) < min_sep for o in starts) or any(np.linalg.norm(g - o) < min_sep for o in goals):
+            continue
+        starts.append(s)
+        goals.append(g)
+    if len(starts) < n:
+        raise ValueError(f'Found only {len(starts)} of {n} start/goal pairs, lower min_sep or min_dist')
+    return list(zip(starts, goals))
+
+class MultiAgentSim:
+    '''
+    Several robots on one map, each with its own solver, stepped in lockstep:
+        every active agent solves concurrently (one thread per agent, the solves are
+        blocking native / socket calls) with the other agents' predicted horizons from
+        the previous step packed as extra dynamic obstacles (circles of agent_radius
+        + path_planning.dynobs_inflation, so the solving agent's own footprint is kept
+        clear of them; scripted obstacles are packed with their raw radii)
+        the first command of every solution is applied with dyn_prop_np
+        the new solutions are rolled out into the predictions the others see next step
+    An agent within goal_tol of the end of its reference stops and stays as a static
+    circle, an agent whose solve fails brakes for that step
+    '''
+    def __init__(self, p : Parameters, agents, agent_radius=0.3, goal_tol=0.5):
+        self.p = p
+        self.agents = agents
+        self.radius = agent_radius + path_planning.dynobs_inflation(p)
+        self.goal_tol = goal_tol
+        self.pool = ThreadPoolExecutor(max_workers=max(len(agents), 1))
+
+    def others(self, j):
+        #(K,N,5) states of every agent except j
+        preds = [a.prediction for i, a in enumerate(self.agents) if i != j]
+        out = np.zeros((len(preds), self.p.N_hor, 5))
+        if preds:
+            out[:,:,:2] = preds
+            out[:,:,2:4] = self.radius
+        return out
+
+    def _solve(self, j, i):
+        agent, p = self.agents[j], self.p
+        seg = agent.tracker.window(agent.x, p.N_hor + 1)
+        t0 = time.perf_counter()
+        try:
+            u_seq, error = agent.controller.solve(agent.x, agent.u_prev, seg, (i + 2)*p.dt, self.others(j)), None
+        except Exception as e: #any solver or transport error, the agent brakes this step
+            u_seq, error = None, e
+        return u_seq, time.perf_counter() - t0, error
+
+    def run(self, steps=None, verbose=False):
+        '''
+        returns the per step Telemetry (MA_COLUMNS) and the (steps, n_agents) solve times in ms
+        '''
+        p, agents = self.p, self.agents
+        steps = int(1.25*max(len(a.ref) for a in agents)) if steps is None else steps
+        for agent in agents:
+            agent.controller.reset(episode_steps=steps + 3)
+        tel = Telemetry(steps, MA_COLUMNS)
+        solve_ms = np.full((steps, len(agents)), np.nan)
+
+        for i in range(steps):
+            active = [j for j, a in enumerate(agents) if not a.done]
+            if not active:
+                break
+            t0 = time.perf_counter()
+            results = list(self.pool.map(lambda j: self._solve(j, i), active))
+            t1 = time.perf_counter()
+
+            failures = 0
+            for j, (u_seq, t_solve, error) in zip(active, results):
+                agent = agents[j]
+                solve_ms[i, j] = 1e3*t_solve
+                if u_seq is None:
+                    failures += 1
+                    if verbose:
+                        print(f'Step {i}: {agent.name} solve failed ({error})')
+                    u = brake_command(agent.u_prev, p)
+                    agent.u_seq = np.tile(u, p.N_hor) #hold the braking command in the prediction
+                else:
+                    agent.u_seq = np.asarray(u_seq, dtype=np.float64)
+                    u = agent.u_seq[:p.n_cmds]
+                agent.prediction = rollout(agent.x, agent.u_seq, p)
+                agent.u_prev = np.array(u, dtype=np.float64)
+                agent.x = dyn_prop_np(agent.x, agent.u_prev, p).flatten()
+                agent.traj.append(agent.x.copy())
+                if np.linalg.norm(agent.x[:2] - agent.ref[-1, :2]) < self.goal_tol:
+                    agent.done = True
+                    agent.u_prev = np.zeros(p.n_cmds)
+                    agent.prediction = np.repeat(agent.x[None, :2], p.N_hor, axis=0)
+            pos = np.array([a.x[:2] for a in agents])
+            d = np.linalg.norm(pos[:, None] - pos[None], axis=2)
+            d[np.diag_indices(len(agents))] = np.inf
+            tel.record(i, t_step_ms=1e3*(t1 - t0), t_solve_max_ms=np.nanmax(solve_ms[i]),
+                       t_solve_mean_ms=np.nanmean(solve_ms[i]), t_exchange_ms=1e3*(time.perf_counter() - t1),
+                       active=len(active), failures=failures, min_sep=d.min() if len(agents) > 1 else np.nan)
+            if verbose:
+                print(f'Step {i}: {len(active)} active, step {1e3*(t1 - t0):.1f} ms, '
+                      f'min separation {tel.data["min_sep"][i]:.2f} m')
+        return tel, solve_ms[:tel.n]
+
+    def close(self):
+        self.pool.shutdown()
+        for agent in self.agents:
+            agent.controller.close()
+
+def build_agents(p : Parameters, planner : path_planning.PathPlanner, pairs, backend='open', base_port=8500):
+    '''
+    One Agent per (start, goal) pair, the OpEn solver is built once and every agent
+    gets its own TCP server on base_port + k, IPOPT agents their own nlpsol instance
+    '''
+    if backend == 'open':
+        build_dir, name = mpcopEn.open_solver(p, verbose=False)
+    agents = []
+    for k, (start, goal) in enumerate(pairs):
+        path = planner.query(start, goal)
+        ref_trajectory = path_planning.generate_reftrajectory(p, path)
+        if backend == 'open':
+            mng = mpcopEn.start_manager(build_dir, name, 'tcp', port=base_port + k)
+            controller = mpcopEn.OpEnController(p, mng=mng, owns_mng=True) #the agent's server goes down with it
+        else:
+            controller = mpcopEn.make_controller(p, backend)
+        agents.append(Agent(f'agent{k}', ref_trajectory, controller.build(), p))
+    return agents
+
+def latency_scaling(config='test_config2', counts=(1, 2, 4, 8, 16), backend='open', steps=100, seed=0,
+                    path='obsbounds.yaml', base_port=8500):
+    '''
+    Per step latency (all agents solved) for growing numbers of agents on one map
+    parallelism = sum of the agents' solve times / step wall time
+    Every count gets its own port range, the servers of the previous one may still be going down
+    '''
+    scn = scenario.load_scenario(config, path)
+    p, planner = scn.params(), scn.planner()
+    results = {}
+    for n in counts:
+        pairs = random_agents(planner, n, seed)
+        sim = MultiAgentSim(p, build_agents(p, planner, pairs, backend, base_port))
+        base_port += n
+        try:
+            tel, solve_ms = sim.run(steps)
+        finally:
+            sim.close()
+        step = tel['t_step_ms']
+        busy = np.nansum(solve_ms, axis=1)
+        results[n] = {'step_ms_p50': float(np.percentile(step, 50)),
+                      'step_ms_p95': float(np.percentile(step, 95)),
+                      'step_ms_max': float(step.max()),
+                      'solve_ms_mean': float(np.nanmean(solve_ms)),
+                      'parallelism': float(np.mean(busy / step)),
+                      'min_sep': float(np.nanmin(tel['min_sep'])) if n > 1 else None}
+        r = results[n]
+        print(f'{n:3d} agents: step p50 {r["step_ms_p50"]:.1f} ms, p95 {r["step_ms_p95"]:.1f} ms, '
+              f'max {r["step_ms_max"]:.1f} ms, solve mean {r["solve_ms_mean"]:.1f} ms, '
+              f'parallelism {r["parallelism"]:.2f}')
+    return results
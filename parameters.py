@@ -1,3 +1,9 @@
+#Fields passed to the solver through z at runtime, in this order (see mpcopEn.param_layout)
+TUNABLE_FIELDS = ('pos_dev', 'heading_dev', 'vel_dev', 'lin_vel_pen', 'ang_vel_pen', 'lin_acc_pen', 'ang_acc_pen',
+                  'termcost_pos', 'termcost_heading', 'w_soft', 'm_soft',
+                  'vel_min', 'vel_max', 'ang_vel_min', 'ang_vel_max',
+                  'lin_acc_min', 'lin_acc_max', 'ang_acc_min', 'ang_acc_max')
+
 class Parameters:
     def __init__(self, obstacles, boundaries, dynobs):
         self.vel_min = -0.5
@@ -21,17 +27,22 @@ class Parameters:
         self.heading_dev = 1.0 
         self.termcost_pos = 200.0
         self.termcost_heading = 50.0 
+        self.w_soft = 50.0 #soft dynamic obstacle margin weight
+        self.m_soft = 0.5 #soft dynamic obstacle margin
 
         #Helpers 
         self.n_states = 3
         self.n_cmds = 2
+        self.n_ref = 4 #x,y,heading,v per reference sample
 
         #Obstacles and boundaries
         self.obstacles = obstacles
         self.boundaries = boundaries
         self.dynobs = dynobs
         self.r_safe = 0.5
+        self.obs_model = 'segments' #'segments' (wall segments) or 'vertices' (circles around vertices)
         self.max_vert = 20 #max no of vertices
+        self.max_seg = 8 #max no of wall segments per step
         self.w_obs = 1e6 #obstacle weigth
         self.vehicle_margin = 0.25
-        self.n_dynobs = 1
+        self.max_dynobs = 4 #dynamic obstacle slots compiled into the solver, any number can be passed in dynobs
@@ -1,16 +1,25 @@
 import os
-os.environ["NUMBA_DISABLE_JIT"] = "1"
-from extremitypathfinder import PolygonEnvironment
-import matplotlib.pyplot as plt
-from matplotlib.patches import Ellipse
+#numba JIT is off unless MPC_NUMBA_JIT=1, compiled functions are then cached on disk
+if os.environ.get("MPC_NUMBA_JIT") == "1":
+    os.environ.setdefault("NUMBA_CACHE_DIR", os.path.join(os.environ.get("MPC_CACHE_DIR", ".cache"), "numba"))
+else:
+    os.environ["NUMBA_DISABLE_JIT"] = "1"
+import json
+import pickle
+import hashlib
+from collections import OrderedDict
+from importlib.metadata import version
 import numpy as np
 import pyclipper
 import yaml
-import math
 from parameters import Parameters
 
 
 SCALE = 1000
+CACHE_DIR = os.environ.get("MPC_CACHE_DIR", ".cache")
+_environments = {} #prepared environments already loaded in this process
+_distance_fields = OrderedDict() #signed distance fields already built in this process, see signed_distance_field
+DYNOBS_AMP = 1.5 #amplitude of the dynamic obstacle wiggle
 
 def to_clipper(polygon):
     return [(int(round(x*SCALE)),int(round(y*SCALE))) for x,y in polygon] #float to int
@@ -66,70 +75,262 @@ def shrink_boundary(boundary, vehicle_width):
     shrunkpath = path_offset(ogpath,-vehicle_width)
     return make_ccw(from_clipper(shrunkpath))
 
-def rotate_object(origin,point,seg_heading):
-    '''
-    Helper for generate dyn obs
-    Inputs
-    origin: first point in segment p1, center of local frame
-    point: point of interest p3 along line we want to convert
-    seg_heading: angle of segmetn wrt global frame
-    '''
-    cx,cy = origin 
-    px,py = point 
-    #Rotate into local frame
-    qx = math.cos(seg_heading) * (px-cx) - math.sin(seg_heading)*(py-cy)
-    qy = math.sin(seg_heading) * (px-cx) + math.cos(seg_heading)*(py-cy) 
-
-    return np.array([qx,qy])
-
-def rotate_and_add(p1,p3,seg_heading,addition):
-
-    rot = rotate_object(p1,p3,seg_heading) #rotate and translate into local frame
-    rot[1] += addition #offset perpendicularly to segment (squiglywiggly)
-    rot = rotate_object(np.array([0,0]),rot,-seg_heading) #rotate back into global frame
-
-    return rot + p1 #translation back into 0,0 origin
-
-def gen_dynamic_obstacle(p1,p2,freq,time,amp=1.5):
-    p1 = np.array(p1)
-    p2 = np.array(p2)
-    dp = p2 - p1
-    seg_heading = np.arctan2(dp[1],dp[0]) #segment heading
-    time = np.array(time) 
-    t = abs(np.sin(freq*time)) #time "trajectory"
-    if type(t) == np.ndarray: #check if numpy array
-        t = np.expand_dims(t,1) #ensure (n,1) instead of (n,)
-    p3 = t*p1 + (1-t)*p2
-    add = amp*np.cos(10*freq*time) #the addition vertical sqwig
-    new = rotate_and_add(p1,p3,seg_heading,add)
-    
-    return new #return time specific point in global frame
-    
+class SpatialGrid:
+    '''
+    Uniform grid over 2d points, built once per map
+    points: (n,2) array
+    cell: grid spacing in meters
+    Cells are stored CSR style (point indices sorted by cell + start offsets) so a
+    query only touches the cells overlapping its bounding box
+    '''
+    def __init__(self, points, cell=2.0):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1,2)
+        self.cell = float(cell)
+        if len(self.points) == 0:
+            self.origin = np.zeros(2)
+            self.shape = np.array([1,1])
+            self.order = np.zeros(0, dtype=np.int64)
+            self.starts = np.zeros(2, dtype=np.int64)
+            return
+        self.origin = self.points.min(axis=0)
+        cells = np.floor((self.points - self.origin) / self.cell).astype(np.int64)
+        self.shape = cells.max(axis=0) + 1
+        flat = cells[:,0]*self.shape[1] + cells[:,1]
+        self.order = np.argsort(flat, kind='stable')
+        self.starts = np.searchsorted(flat[self.order], np.arange(self.shape[0]*self.shape[1] + 1))
+
+    def query_radius(self, center, radius):
+        '''
+        Indices of points within radius of center
+        '''
+        center = np.asarray(center, dtype=np.float64)
+        lo = np.floor((center - radius - self.origin) / self.cell).astype(np.int64)
+        hi = np.floor((center + radius - self.origin) / self.cell).astype(np.int64)
+        lo = np.maximum(lo, 0)
+        hi = np.minimum(hi, self.shape - 1)
+        if np.any(lo > hi):
+            return np.zeros(0, dtype=np.int64)
+        ny = self.shape[1]
+        #cells with the same x index are contiguous, so each x column is one slice
+        rows = [self.order[self.starts[ix*ny + lo[1]]:self.starts[ix*ny + hi[1] + 1]]
+                for ix in range(lo[0], hi[0] + 1)]
+        idx = np.concatenate(rows)
+        d2 = np.sum((self.points[idx] - center)**2, axis=1)
+        return idx[d2 <= radius**2]
+
+    def nearest(self, center, radius, k):
+        '''
+        Indices of the (at most) k points closest to center within radius, closest first
+        '''
+        idx = self.query_radius(center, radius)
+        d2 = np.sum((self.points[idx] - np.asarray(center))**2, axis=1)
+        if len(idx) > k:
+            keep = np.argpartition(d2, k)[:k]
+            idx, d2 = idx[keep], d2[keep]
+        return idx[np.argsort(d2)]
+
+
+def obstacle_segments(polygons, boundary=None):
+    '''
+    Decomposes closed polygons (and optionally the map boundary) into wall segments
+    returns (S,4) array of [ax,ay,bx,by]
+    '''
+    polys = [np.asarray(poly, dtype=np.float64) for poly in polygons]
+    if boundary is not None:
+        polys.append(np.asarray(boundary, dtype=np.float64))
+    if not polys:
+        return np.zeros((0,4))
+    return np.vstack([np.hstack([poly, np.roll(poly, -1, axis=0)]) for poly in polys])
+
+def segment_distances(points, segs):
+    '''
+    (P,S) euclidean distances from points (P,2) to segments (S,4)
+    '''
+    points = np.asarray(points, dtype=np.float64).reshape(-1,2)
+    a = segs[:,:2]
+    ab = segs[:,2:] - a
+    ap = points[:,None,:] - a[None,:,:]
+    t = np.sum(ap*ab, axis=2) / np.maximum(np.sum(ab*ab, axis=1), 1e-12)
+    t = np.clip(t, 0.0, 1.0)
+    d = ap - t[:,:,None]*ab
+    return np.sqrt(np.sum(d*d, axis=2))
+
+def points_in_polygon(points, polygon):
+    '''
+    Even-odd ray casting for many points against one polygon
+    '''
+    px, py = points[:,0], points[:,1]
+    poly = np.asarray(polygon, dtype=np.float64)
+    inside = np.zeros(len(points), dtype=bool)
+    for (ax,ay),(bx,by) in zip(poly, np.roll(poly, -1, axis=0)):
+        if ay == by:
+            continue
+        crosses = (ay > py) != (by > py)
+        x_cross = ax + (py - ay)*(bx - ax)/(by - ay)
+        inside ^= crosses & (px < x_cross)
+    return inside
+
+class SegmentIndex:
+    '''
+    Nearest wall segments around a point
+    Every segment is sampled at half the grid spacing into a SpatialGrid, so long walls
+    are found even when both of their endpoints are far away
+    '''
+    def __init__(self, segs, cell=2.0):
+        self.segs = np.asarray(segs, dtype=np.float64).reshape(-1,4)
+        self.step = 0.5*cell
+        samples, owners = [], []
+        for k,(ax,ay,bx,by) in enumerate(self.segs):
+            n = max(int(np.ceil(np.hypot(bx-ax, by-ay) / self.step)), 1)
+            t = np.linspace(0.0, 1.0, n+1)
+            samples.append(np.column_stack([ax + t*(bx-ax), ay + t*(by-ay)]))
+            owners.append(np.full(n+1, k))
+        self.owner = np.concatenate(owners) if owners else np.zeros(0, dtype=np.int64)
+        self.grid = SpatialGrid(np.vstack(samples) if samples else np.zeros((0,2)), cell)
+
+    def nearest(self, center, radius, k):
+        '''
+        Indices of the (at most) k segments closest to center within radius, closest first
+        '''
+        #samples are at most step/2 away from the closest point of their segment
+        cand = np.unique(self.owner[self.grid.query_radius(center, radius + 0.5*self.step)])
+        d = segment_distances(center, self.segs[cand])[0]
+        cand, d = cand[d <= radius], d[d <= radius]
+        if len(cand) > k:
+            keep = np.argpartition(d, k)[:k]
+            cand, d = cand[keep], d[keep]
+        return cand[np.argsort(d)]
+
+class SignedDistanceField:
+    '''
+    Distance to the closest wall sampled on a regular grid, negative inside holes and
+    outside the boundary. Queried with bilinear interpolation
+    The grid is filled in tiles of tile x tile cells, each against only the segments that
+    can be the closest one to some cell of the tile
+    '''
+    def __init__(self, obstacles, boundary, res=0.2, margin=1.0, tile=16):
+        self.segs = obstacle_segments(obstacles, boundary)
+        bnd = np.asarray(boundary, dtype=np.float64)
+        self.origin = bnd.min(axis=0) - margin
+        self.res = float(res)
+        self.shape = np.ceil((bnd.max(axis=0) + margin - self.origin) / self.res).astype(np.int64) + 1
+        gx = self.origin[0] + self.res*np.arange(self.shape[0])
+        gy = self.origin[1] + self.res*np.arange(self.shape[1])
+
+        dist = np.empty(tuple(self.shape))
+        for i in range(0, self.shape[0], tile):
+            for j in range(0, self.shape[1], tile):
+                tx, ty = gx[i:i+tile], gy[j:j+tile]
+                center = np.array([0.5*(tx[0] + tx[-1]), 0.5*(ty[0] + ty[-1])])
+                #every cell is within half the diagonal of the center, so a segment further
+                #than the closest one + the diagonal is never the closest to any cell
+                d_center = segment_distances(center, self.segs)[0]
+                near = self.segs[d_center <= d_center.min() + np.hypot(tx[-1] - tx[0], ty[-1] - ty[0])]
+                pts = np.stack(np.meshgrid(tx, ty, indexing='ij'), axis=-1).reshape(-1,2)
+                dist[i:i+tile, j:j+tile] = segment_distances(pts, near).min(axis=1).reshape(len(tx), len(ty))
+        pts = np.stack(np.meshgrid(gx, gy, indexing='ij'), axis=-1).reshape(-1,2)
+        blocked = ~points_in_polygon(pts, bnd)
+        for hole in obstacles:
+            blocked |= points_in_polygon(pts, hole)
+        dist = dist.reshape(-1)
+        dist[blocked] *= -1.0
+        self.values = dist.reshape(self.shape)
+
+    def __call__(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1,2)
+        f = (points - self.origin) / self.res
+        i = np.clip(np.floor(f).astype(np.int64), 0, self.shape - 2)
+        w = np.clip(f - i, 0.0, 1.0)
+        v = self.values
+        v00, v10 = v[i[:,0], i[:,1]], v[i[:,0]+1, i[:,1]]
+        v01, v11 = v[i[:,0], i[:,1]+1], v[i[:,0]+1, i[:,1]+1]
+        return (v00*(1-w[:,0])*(1-w[:,1]) + v10*w[:,0]*(1-w[:,1])
+                + v01*(1-w[:,0])*w[:,1] + v11*w[:,0]*w[:,1])
+
+
+def signed_distance_field(obstacles, boundary, cache_size=8):
+    '''
+    SignedDistanceField of a map, built once per geometry and process and shared
+    by every episode on it (LRU of the last cache_size maps)
+    '''
+    key = geometry_key(boundary, obstacles, 0.0)
+    if key in _distance_fields:
+        _distance_fields.move_to_end(key)
+        return _distance_fields[key]
+    sdf = SignedDistanceField(obstacles, boundary)
+    _distance_fields[key] = sdf
+    if len(_distance_fields) > cache_size:
+        _distance_fields.popitem(last=False)
+    return sdf
+
+
+class DynObsTable:
+    '''
+    Motion of M dynamic obstacles, evaluated for a whole time grid at once
+    dynobs: list of (p1, p2, freq, x_rad, y_rad, heading)
+    Each obstacle swings between p2 and p1 as |sin(f t)| and wiggles with amp*cos(10 f t)
+    along (sin h, cos h), h the heading of p1->p2 (the original model: perpendicular to
+    the segment only when it is axis aligned)
+    The motion only depends on t, so with dt and steps given the states on the
+    grid k*dt are computed once (per episode) and window() just slices them
+    '''
+    def __init__(self, dynobs, amp=DYNOBS_AMP, dt=None, steps=0):
+        M = len(dynobs)
+        self.p1 = np.array([obs[0] for obs in dynobs], dtype=np.float64).reshape(M,2)
+        self.p2 = np.array([obs[1] for obs in dynobs], dtype=np.float64).reshape(M,2)
+        self.freq = np.array([obs[2] for obs in dynobs], dtype=np.float64).reshape(M)
+        self.shape = np.array([obs[3:6] for obs in dynobs], dtype=np.float64).reshape(M,3) #x_rad, y_rad, heading
+        dp = self.p2 - self.p1
+        seg_heading = np.arctan2(dp[:,1], dp[:,0])
+        self.wiggle_dir = amp*np.stack([np.sin(seg_heading), np.cos(seg_heading)], axis=1)
+        self.dt = dt
+        self.grid = self.states(dt*np.arange(steps)) if dt is not None and steps > 0 else None
+
+    def __len__(self):
+        return len(self.p1)
+
+    def states(self, times, inflate=0.0):
+        '''
+        (M,T,5) block of x, y, x_rad, y_rad, heading for every obstacle and time
+        inflate is added to both radii
+        '''
+        times = np.atleast_1d(np.asarray(times, dtype=np.float64))
+        ft = self.freq[:,None]*times[None,:]
+        frac = np.abs(np.sin(ft))[:,:,None]
+        wiggle = np.cos(10.0*ft)[:,:,None]
+        out = np.empty((len(self), len(times), 5))
+        out[:,:,:2] = self.p2[:,None,:] + frac*(self.p1 - self.p2)[:,None,:] + wiggle*self.wiggle_dir[:,None,:]
+        out[:,:,2:] = self.shape[:,None,:]
+        out[:,:,2:4] += inflate
+        return out
+
+    def window(self, t0, n):
+        '''
+        States at t0, t0+dt, .., served from the episode grid when t0 is on it
+        '''
+        if self.grid is not None:
+            k = int(round(t0/self.dt))
+            if abs(k*self.dt - t0) < 1e-9 and 0 <= k and k + n <= self.grid.shape[1]:
+                return self.grid[:,k:k+n]
+        return self.states(t0 + self.dt*np.arange(n) if self.dt is not None else t0)
+
+def dynobs_inflation(p:Parameters):
+    return p.r_safe/2 + p.vehicle_margin #Expand object based on vehicle width and margin
+
+def gen_dynamic_obstacle(p1,p2,freq,time,amp=DYNOBS_AMP):
+    #Position at time (scalar -> (2,), array -> (n,2)) of a single obstacle
+    xy = DynObsTable([(p1,p2,freq,0.0,0.0,0.0)], amp).states(time)[0,:,:2]
+    return xy[0] if np.ndim(time) == 0 else xy
 
 def get_dynobs_paths(dynobs_total,t,p:Parameters):
-    dt = p.dt
-    horizon = p.N_hor
-    time = np.linspace(t,t+horizon*dt,horizon) #time array according to prediction horizon
-    dynobs_paths = []
-    for obs in dynobs_total:
-        p1,p2,freq,x_rad,y_rad, seg_heading = obs #TODO: Engrave obstacle info into .yaml file
-        x_rad = x_rad + p.r_safe/2 + p.vehicle_margin #Expand object based on vehicle width and margin
-        y_rad = y_rad + p.r_safe/2 + p.vehicle_margin
-        obap = [*gen_dynamic_obstacle(p1,p2,freq,t),x_rad,y_rad,seg_heading] #the 5 time based parameters mentioned in paper
-        dynobs_paths.append(obap)
-    
-    return dynobs_paths
+    #(M,N_hor,5) inflated obstacle states over the prediction horizon starting at t
+    time = t + p.dt*np.arange(p.N_hor)
+    return DynObsTable(dynobs_total).states(time, dynobs_inflation(p))
 
 def get_dynobs_path_at_t(dynobs_total,t,p:Parameters):
-    dynobs_paths = []
-    for obs in dynobs_total:
-        p1,p2,freq,x_rad,y_rad, seg_heading = obs #TODO: Engrave obstacle info into .yaml file
-        x_rad = x_rad + p.r_safe/2 + p.vehicle_margin #Expand object based on vehicle width and margin
-        y_rad = y_rad + p.r_safe/2 + p.vehicle_margin
-        x,y = gen_dynamic_obstacle(p1,p2,freq,t)
-        #print(f'Generated dynamic obstacle at {x}, {y}')
-        dynobs_paths.append((x,y,x_rad,y_rad,seg_heading))
-    return dynobs_paths
+    #list of (x,y,x_rad,y_rad,heading) per obstacle at time t, radii inflated
+    states = DynObsTable(dynobs_total).states(t, dynobs_inflation(p))[:,0]
+    return [tuple(row) for row in states]
 
 def path_interpolate(path,ds = 0.1):
     '''
@@ -161,39 +362,266 @@ def path_interpolate(path,ds = 0.1):
 
     return np.column_stack([x,y])
 
-def gen_path(config):
-    #Main part
-    environment = PolygonEnvironment()
-
-    with open('obsbounds.yaml','r') as file:
+class RefTracker:
+    '''
+    Progress indexed reference window
+    ref_trajectory: (P,c) array sampled every dt (generate_reftrajectory), first two
+    columns x,y, remaining columns (heading, v) are interpolated (heading is unwrapped first)
+    The robot is located on the path by a local search over the next `window`
+    samples after the previous match, the first lookup (or a reacquire after a
+    large jump) goes through a SpatialGrid. window() then returns the samples
+    following the robot's fractional index, one per stage, so the reference keeps
+    its timing but waits for the robot instead of running ahead of it
+    '''
+    def __init__(self, ref_trajectory, window=50, back=5, reacquire=2.0, cell=2.0):
+        self.ref = np.array(ref_trajectory, dtype=np.float64)
+        if self.ref.shape[1] > 2:
+            self.ref[:,2] = np.unwrap(self.ref[:,2])
+        xy = self.ref[:,:2]
+        self.s = np.r_[0.0, np.cumsum(np.linalg.norm(np.diff(xy, axis=0), axis=1))]
+        self.window_len, self.back, self.reacquire = window, back, reacquire
+        self.grid = SpatialGrid(xy, cell)
+        self.idx = None
+        self.dist = np.inf #distance from the robot to the matched path sample
+
+    def _global(self, pos):
+        radius = self.grid.cell
+        span = np.linalg.norm(self.grid.shape*self.grid.cell) + np.linalg.norm(pos - self.grid.origin)
+        while radius <= span:
+            idx = self.grid.nearest(pos, radius, 1)
+            if len(idx):
+                return int(idx[0])
+            radius *= 2
+        return int(np.argmin(np.sum((self.ref[:,:2] - pos)**2, axis=1)))
+
+    def locate(self, pos):
+        '''
+        Arc length of the robot's projection on the path
+        '''
+        pos = np.asarray(pos[:2], dtype=np.float64)
+        xy = self.ref[:,:2]
+        if self.idx is not None:
+            lo, hi = max(self.idx - self.back, 0), min(self.idx + self.window_len, len(xy))
+            d = np.linalg.norm(xy[lo:hi] - pos, axis=1)
+            j = lo + int(np.argmin(d))
+            if d[j - lo] > self.reacquire:
+                j = self._global(pos)
+        else:
+            j = self._global(pos)
+        self.idx = j
+        self.dist = float(np.linalg.norm(xy[j] - pos))
+        if len(xy) < 2:
+            return 0.0
+        k = min(j, len(xy) - 2)
+        tangent = xy[k+1] - xy[k]
+        seg_len = np.linalg.norm(tangent)
+        proj = np.dot(pos - xy[j], tangent)/seg_len if seg_len > 0 else 0.0
+        return float(np.clip(self.s[j] + proj, self.s[max(j-1, 0)], self.s[min(j+1, len(xy)-1)]))
+
+    def window(self, pos, n_samples):
+        '''
+        (n_samples, c) reference starting at the robot's progress, padded with the
+        last sample past the end of the path
+        '''
+        s_now = self.locate(pos)
+        n = len(self.s)
+        lo = max(self.idx - 1, 0)
+        hi = min(self.idx + 2, n)
+        #fractional sample index of the robot, then one sample (dt) per stage
+        u_now = np.interp(s_now, self.s[lo:hi], np.arange(lo, hi))
+        u_query = np.minimum(u_now + np.arange(n_samples), n - 1)
+        hi = min(int(np.ceil(u_query[-1])) + 1, n)
+        lo = int(np.floor(u_now))
+        return np.column_stack([np.interp(u_query, np.arange(lo, hi), col) for col in self.ref[lo:hi].T])
+
+def load_map(config, map_file='obsbounds.yaml'):
+    with open(map_file,'r') as file:
         config_data = yaml.safe_load(file)
 
     boundary_coordinates = config_data[config]['boundary_coordinates']
     list_of_holes = config_data[config]['list_of_holes']
     #dynobs = config_data[config]['dynobs']
-    
-    obstacles_processed = inflate_obstacles(list_of_holes, 0.5)
-    boundary_processed = shrink_boundary(boundary_coordinates, vehicle_width=0.5)
+    return boundary_coordinates, list_of_holes
 
+def geometry_key(boundary_coordinates, list_of_holes, vehicle_width):
+    blob = json.dumps([np.asarray(boundary_coordinates, dtype=float).round(6).tolist(),
+                       [np.asarray(h, dtype=float).round(6).tolist() for h in list_of_holes],
+                       float(vehicle_width), version("extremitypathfinder")])
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+def prepared_environment(boundary_coordinates, list_of_holes, vehicle_width=0.5, name='map'):
+    '''
+    Inflated obstacles and the prepared visibility graph of a map
+    Cached in memory and pickled to CACHE_DIR/<name>_<width>_<geometry hash>.pkl,
+    so only the first run on a map pays for offsetting and prepare()
+    '''
+    key = geometry_key(boundary_coordinates, list_of_holes, vehicle_width)
+    if key in _environments:
+        return _environments[key]
+    cache_file = os.path.join(CACHE_DIR, f'{name}_{vehicle_width:g}_{key[:12]}.pkl')
+    try:
+        with open(cache_file, 'rb') as file:
+            _environments[key] = pickle.load(file)
+        return _environments[key]
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        pass #missing or stale, rebuild below
+
+    from extremitypathfinder import PolygonEnvironment #only needed to build, the pickle imports it itself
+    environment = PolygonEnvironment()
+    obstacles_processed = inflate_obstacles(list_of_holes, vehicle_width)
+    boundary_processed = shrink_boundary(boundary_coordinates, vehicle_width=vehicle_width)
     environment.store(boundary_processed, obstacles_processed, validate=True)
-    environment.prepare()
-
-    start_coordinates = (1.0, 25.0)
-    goal_coordinates = (49.0, 30.0)
-    path, length = environment.find_shortest_path(start_coordinates, goal_coordinates)
-    path = np.array(path, dtype=np.float32)
-    path = path_interpolate(path)
-    padded_vertices = obstacles_processed
-    return path , list_of_holes, boundary_coordinates, padded_vertices
+    if not environment.prepared: #newer versions prepare inside store()
+        environment.prepare()
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp' #parallel workers may race on the same map
+    with open(tmp_file, 'wb') as file:
+        pickle.dump((environment, obstacles_processed), file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    _environments[key] = (environment, obstacles_processed)
+    return _environments[key]
+
+class PathPlanner:
+    '''
+    Shortest path queries on one map, the visibility graph is prepared (or loaded
+    from the cache) once in the constructor
+    Results are memoized in an LRU cache keyed on start/goal rounded to snap, so
+    repeated or nearby queries reuse the graph search. The cached corner path gets
+    the exact start/goal of the query before it is interpolated
+    '''
+    def __init__(self, boundary_coordinates, list_of_holes, vehicle_width=0.5, name='map',
+                 cache_size=1024, snap=0.05, ds=0.1):
+        self.environment, self.padded_obstacles = prepared_environment(boundary_coordinates, list_of_holes,
+                                                                       vehicle_width, name)
+        self.cache_size, self.snap, self.ds = cache_size, snap, ds
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+
+    @classmethod
+    def from_config(cls, config, map_file='obsbounds.yaml', **kwargs):
+        boundary_coordinates, list_of_holes = load_map(config, map_file)
+        return cls(boundary_coordinates, list_of_holes, name=config, **kwargs)
+
+    def corners(self, start_coordinates, goal_coordinates):
+        key = tuple(np.round(np.concatenate([start_coordinates, goal_coordinates])/self.snap).astype(int))
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+        path, length = self.environment.find_shortest_path(tuple(start_coordinates), tuple(goal_coordinates))
+        corners = np.array(path, dtype=np.float32) if len(path) else None
+        self.cache[key] = corners
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return corners
+
+    def query(self, start_coordinates, goal_coordinates):
+        corners = self.corners(start_coordinates, goal_coordinates)
+        if corners is None:
+            raise RuntimeError(f'No path from {tuple(start_coordinates)} to {tuple(goal_coordinates)}')
+        corners = corners.copy()
+        corners[0], corners[-1] = start_coordinates, goal_coordinates
+        return path_interpolate(corners, self.ds)
+
+    def query_batch(self, starts, goals):
+        '''
+        Paths for every (start, goal) pair, None where there is no path
+        or an endpoint is outside the free space
+        '''
+        paths = []
+        for start, goal in zip(starts, goals):
+            try:
+                paths.append(self.query(start, goal))
+            except (RuntimeError, ValueError):
+                paths.append(None)
+        return paths
+
+def plan_path(boundary_coordinates, list_of_holes, start_coordinates=(1.0, 25.0),
+              goal_coordinates=(49.0, 30.0), vehicle_width=0.5, name='map'):
+    '''
+    Shortest path through the inflated map
+    returns the interpolated path and the inflated obstacles
+    '''
+    planner = PathPlanner(boundary_coordinates, list_of_holes, vehicle_width, name)
+    return planner.query(start_coordinates, goal_coordinates), planner.padded_obstacles
 
-def generate_reftrajectory(p:Parameters,init_path):
-    x_ref = init_path[:,0]
-    y_ref = init_path[:,1] 
-    dx = np.diff(x_ref,prepend=init_path[0,0])
-    dy = np.diff(y_ref,prepend=init_path[0,1])
-    theta_ref = np.unwrap(np.arctan2(dy,dx))
-    return np.vstack((x_ref, y_ref, theta_ref)).T
+def gen_path(config):
+    #Main part
+    boundary_coordinates, list_of_holes = load_map(config)
+    path, padded_vertices = plan_path(boundary_coordinates, list_of_holes, name=config)
+    return path , list_of_holes, boundary_coordinates, padded_vertices
 
+def random_map(seed, n_obs=12, size=50.0, start=(1.0, 25.0), goal=(49.0, 30.0), keepout=3.0, gap=1.5):
+    '''
+    Square map with n_obs random rectangles (CW), kept away from start/goal and
+    from each other so the inflated map stays valid
+    '''
+    rng = np.random.default_rng(seed)
+    boundary = [[0.0, 0.0], [size, 0.0], [size, size], [0.0, size]]
+    holes, boxes = [], []
+    for _ in range(100*n_obs):
+        if len(holes) == n_obs:
+            break
+        w, h = rng.uniform(1.0, 8.0, 2)
+        x0, y0 = rng.uniform(gap, size - gap - w), rng.uniform(gap, size - gap - h)
+        box = np.array([x0 - gap, y0 - gap, x0 + w + gap, y0 + h + gap])
+        if any(box[0] < b[2] and b[0] < box[2] and box[1] < b[3] and b[1] < box[3] for b in boxes):
+            continue
+        near = [np.hypot(np.clip(px, x0, x0+w) - px, np.clip(py, y0, y0+h) - py) < keepout
+                for px, py in (start, goal)]
+        if any(near):
+            continue
+        boxes.append(box)
+        holes.append([[x0, y0+h], [x0+w, y0+h], [x0+w, y0], [x0, y0]])
+    return boundary, holes
+
+def speed_profile(path, p:Parameters, v0=0.0, v_end=0.0, smooth=0.5):
+    '''
+    Velocity along an interpolated path
+    The heading is taken over +-smooth meters (the solver rounds corners anyway) so
+    corners turn into arcs, their curvature caps the speed at ang_vel_max/|kappa|.
+    A forward (lin_acc_max) and backward (lin_acc_min) pass then limit the
+    acceleration, both in closed form:
+    v_i^2 = min_j (v_cap_j^2 + 2a|s_i - s_j|) over j before (after) i
+    returns arc length s, smoothed heading and v per path point
+    '''
+    P = np.asarray(path, dtype=np.float64)
+    ds = np.linalg.norm(np.diff(P, axis=0), axis=1)
+    s = np.r_[0.0, np.cumsum(ds)]
+
+    w = max(1, int(round(smooth / max(s[-1]/(len(P) - 1), 1e-9))))
+    idx = np.arange(len(P))
+    lo, hi = np.clip(idx - w, 0, len(P) - 1), np.clip(idx + w, 0, len(P) - 1)
+    chord = P[hi] - P[lo]
+    heading = np.unwrap(np.arctan2(chord[:,1], chord[:,0]))
+    seg_kappa = np.abs(np.diff(heading)) / np.maximum(ds, 1e-9)
+    kappa = np.maximum(np.r_[seg_kappa, 0.0], np.r_[0.0, seg_kappa]) #worst of the two adjacent segments
+    v_cap = np.minimum(p.vel_max, p.ang_vel_max / np.maximum(kappa, 1e-9))
+    v_cap[0], v_cap[-1] = min(v_cap[0], v0), min(v_cap[-1], v_end)
+
+    acc, dec = p.lin_acc_max, -p.lin_acc_min
+    fwd = 2*acc*s + np.minimum.accumulate(v_cap**2 - 2*acc*s)
+    bwd = -2*dec*s + np.minimum.accumulate((v_cap**2 + 2*dec*s)[::-1])[::-1]
+    return s, heading, np.sqrt(np.maximum(np.minimum(fwd, bwd), 0.0))
+
+def generate_reftrajectory(p:Parameters,init_path, v0=0.0):
+    '''
+    Time parameterized reference, one sample per p.dt
+    v0: speed at the first path point (nonzero when replanning on the move)
+    returns (T,4) array x, y, heading, v
+    '''
+    P = np.asarray(init_path, dtype=np.float64)
+    if len(P) < 2:
+        return np.array([[P[0,0], P[0,1], 0.0, 0.0]])
+    s, heading, v = speed_profile(P, p, v0)
+    #trapezoidal travel time per segment, the floor only matters for a zero speed segment
+    t = np.r_[0.0, np.cumsum(np.diff(s) / np.maximum(0.5*(v[1:] + v[:-1]), 1e-3))]
+    t_samples = np.arange(0.0, t[-1], p.dt)
+    if t[-1] - t_samples[-1] > 1e-9:
+        t_samples = np.r_[t_samples, t[-1]]
+    return np.column_stack([np.interp(t_samples, t, col) for col in (P[:,0], P[:,1], heading, v)])
 '''
 # Working test animation of obstacles
 config = 'test_config2'
@@ -4,12 +4,24 @@ from matplotlib.patches import Ellipse
 from matplotlib import animation
 import path_planning
 from parameters import Parameters
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import imageio.v2 as imageio
-from PIL import Image, ImageSequence
+from PIL import Image
+import multiprocessing as mp
 import os
 
-def plot_traj(sim_traj,ref_trajectory,boundary,obstacles,padded_obstacles):
-    plt.figure()
+_scene = {} #Agg figure, cached background and animated artists of the current render process
+
+def _finish(fig, show):
+    #non-blocking, the caller keeps the windows open (plt.show() at the end), otherwise the figure is freed
+    if show:
+        plt.show(block=False)
+    else:
+        plt.close(fig)
+
+def plot_traj(sim_traj,ref_trajectory,boundary,obstacles,padded_obstacles,show=True):
+    fig = plt.figure()
     sim_traj = np.array(sim_traj)
     plt.plot(sim_traj[:,0], sim_traj[:,1],label='Simulated Trajectory')
     plt.plot(ref_trajectory[:,0], ref_trajectory[:,1], 'r--', label='Reference Trajectory')
@@ -29,23 +41,23 @@ def plot_traj(sim_traj,ref_trajectory,boundary,obstacles,padded_obstacles):
     plt.axis('equal')
     plt.grid()
     plt.savefig("postrun_plots/traj_plot.png", dpi=300, bbox_inches="tight")
-    plt.show()
+    _finish(fig, show)
 
-def plot_commands(commands):
+def plot_commands(commands,show=True):
     
-    plt.figure()
+    fig = plt.figure()
     plt.title('Linear Velocity over time')
     plt.plot(commands[:,0], label='v')
     plt.legend(); plt.grid(); 
     plt.savefig("postrun_plots/linvel_plot.png", dpi=300, bbox_inches="tight")
-    plt.show()
+    _finish(fig, show)
 
-    plt.figure()
+    fig = plt.figure()
     plt.title('Angular velocity over time')
     plt.plot(commands[:,1], label='omega')
     plt.legend(); plt.grid();
     plt.savefig("postrun_plots/angvel_plot.png", dpi=300, bbox_inches="tight")
-    plt.show()
+    _finish(fig, show)
 
 def animate_commands(commands,p:Parameters):
     print('Working on command gifs')
@@ -151,139 +163,257 @@ def animate_dymobs(obstacles,boundary,p:Parameters):
         plt.pause(dt)
 
 
-def videoanim(boundary,static_obslist,dyn_obslist,sim_traj,p : Parameters,completed_len, opfile_path = 'postrun_plots/mpcrun.gif'):
-    print('Working on prdoucing GIF')
-    sim_traj = np.stack(sim_traj, axis=0) #ensure right size
-    simxy = sim_traj[:,:2] #pos and heading only
-    T = len(simxy)
-    dt = p.dt
-    t0 = 0.0
-    fps = int(round(1.0/dt))
-
-    fig,ax = plt.subplots(figsize=(7,7))
+def _command_axes(ax, t, values, label, ylabel):
+    #static part of a command over time panel, same layout as animate_commands
+    ax.set_xlim(0, t[-1] if len(t) > 1 else 1.0)
+    vmin, vmax = float(values.min()), float(values.max())
+    pad = max(0.1 * (vmax - vmin), 0.1)
+    ax.set_ylim(vmin - pad, vmax + pad)
+    ax.set_xlabel('time [s]')
+    ax.set_ylabel(ylabel)
+    ax.grid(True)
+    line, = ax.plot([],[],'b--',lw=1,label=label, animated=True)
+    ax.legend(handles=[line], loc='upper right')
+    return line
+
+def _scene_init(scene):
+    '''
+    Draws everything static once on an Agg canvas and keeps its pixels as the background
+    scene: dict with boundary, static_obslist, simxy (T,2), poses (M,T,5), figsize, dpi and
+    optionally palette (GIF output) and commands (T,2) with dt for the v(t), w(t) panels
+    left of the map
+    '''
+    commands = scene.get('commands')
+    fig = Figure(figsize=scene['figsize'], dpi=scene['dpi'])
+    canvas = FigureCanvasAgg(fig)
+    lines = []
+    if commands is None:
+        ax = fig.add_subplot()
+    else:
+        #640x480 command panels next to the 7x7 map, like the side by side GIFs
+        ax_v, ax_w, ax = fig.subplots(1, 3, gridspec_kw={'width_ratios': (4/3, 4/3, 1)})
+        t = scene['dt']*np.arange(len(commands))
+        lines = [(_command_axes(ax_v, t, commands[:,0], 'v(t)', 'linear velocity [m/s]'), ax_v, t, commands[:,0]),
+                 (_command_axes(ax_w, t, commands[:,1], 'w(t)', 'angular velocity [rad/s]'), ax_w, t, commands[:,1])]
     ax.set_aspect('equal',adjustable='box')
+    boundary, simxy, poses = scene['boundary'], scene['simxy'], scene['poses']
 
     #Plot boundary
     bx,by = zip(*boundary)
     ax.plot(list(bx)+[bx[0]], list(by)+[by[0]], 'k-', lw=1.5)
 
     #Plot static obstacles
-    for obs in static_obslist:
+    for obs in scene['static_obslist']:
         sx,sy = zip(*obs)
         ax.plot(list(sx)+[sx[0]], list(sy)+[sy[0]], 'k-')
 
-    robot_dot, = ax.plot([],[],'bo',ms=5)
-    completed_path, = ax.plot([],[],'b--',lw=1)
-
-    #dynamic obstacles
-
+    #Fixed limits covering the map, the run and the obstacle swings, the background never moves
+    pts = [np.asarray(boundary, dtype=float), simxy]
+    if poses.size:
+        reach = np.max(poses[:,:,2:4], axis=2, keepdims=True)
+        pts += [(poses[:,:,:2] - reach).reshape(-1,2), (poses[:,:,:2] + reach).reshape(-1,2)]
+    pts = np.concatenate(pts)
+    lo, hi = pts.min(axis=0), pts.max(axis=0)
+    pad = 0.02*np.max(hi - lo)
+    ax.set_xlim(lo[0] - pad, hi[0] + pad)
+    ax.set_ylim(lo[1] - pad, hi[1] + pad)
+
+    robot_dot, = ax.plot([],[],'bo',ms=5, animated=True)
+    completed_path, = ax.plot([],[],'b--',lw=1, animated=True)
     ellipses = []
-    obs0 = path_planning.get_dynobs_path_at_t(dyn_obslist,t0,p)
-    for (x,y,x_rad,y_rad,ang) in obs0:
-        ellipse = Ellipse((x, y), width=2*x_rad, height=2*y_rad, angle=np.degrees(ang),
-                    fill=False, linestyle='--', linewidth=1, edgecolor='g')
+    for _ in range(len(poses)):
+        ellipse = Ellipse((0, 0), width=0, height=0, fill=False, linestyle='--', linewidth=1,
+                          edgecolor='g', animated=True)
         ax.add_patch(ellipse)
         ellipses.append(ellipse)
-    
-    #Helpers 
-    def init():
-        robot_dot.set_data([],[])
-        completed_path.set_data([],[])
-
-        return [robot_dot,completed_path,*ellipses]
-    
-    def update(k):
-        t = t0 + k*dt
-        robot_dot.set_data(sim_traj[k,0],sim_traj[k,1]) #select current point
-        start = 0 if completed_path is None else max(0,k-completed_len) #Start so we have completed_len points left
-        completed_path.set_data(sim_traj[:k+1,0],sim_traj[:k+1,1]) #select completed path until k
-
-        #ellipse at time t
 
-        obs = path_planning.get_dynobs_path_at_t(dyn_obslist,t,p)
-        for ellipse, (x,y,x_rad,y_rad,angle) in zip(ellipses,obs):
+    if lines:
+        fig.tight_layout()
+    canvas.draw()
+    _scene.update(fig=fig, canvas=canvas, ax=ax, background=canvas.copy_from_bbox(fig.bbox),
+                  robot_dot=robot_dot, completed_path=completed_path, ellipses=ellipses, lines=lines,
+                  simxy=simxy, poses=poses,
+                  palette=PaletteMap(scene['palette']) if scene.get('palette') is not None else None)
+
+def _render_frames(frames):
+    '''
+    Frames k of the current scene, only the moving artists are redrawn on the background
+    returns (len(frames),H,W,3) uint8 RGB, or (len(frames),H,W) palette indices when the
+    scene has a palette
+    '''
+    sc = _scene
+    canvas, ax, simxy, poses, palette = sc['canvas'], sc['ax'], sc['simxy'], sc['poses'], sc['palette']
+    artists = [sc['completed_path'], sc['robot_dot'], *sc['ellipses']]
+    out = None
+    for n, k in enumerate(frames):
+        canvas.restore_region(sc['background'])
+        sc['robot_dot'].set_data(simxy[k:k+1,0], simxy[k:k+1,1]) #select current point
+        sc['completed_path'].set_data(simxy[:k+1,0], simxy[:k+1,1]) #select completed path until k
+        for ellipse, (x,y,x_rad,y_rad,angle) in zip(sc['ellipses'], poses[:,k]):
             ellipse.set_center((x,y))
             ellipse.width, ellipse.height = 2*x_rad,2*y_rad
             ellipse.angle = np.rad2deg(angle)
-        
-        return [robot_dot, completed_path, *ellipses]
-    
-    anim = animation.FuncAnimation(fig,update, frames=T, init_func=init, interval=int(1000*dt),
-                                   blit=False, repeat=False)
-
-    writer = animation.PillowWriter(fps)
-    anim.save(opfile_path, writer=writer)
-    plt.close(fig)
+        for artist in artists:
+            ax.draw_artist(artist)
+        for line, line_ax, t, values in sc['lines']:
+            line.set_data(t[:k+1], values[:k+1]) #select until k
+            line_ax.draw_artist(line)
+        img = np.asarray(canvas.buffer_rgba())[:,:,:3]
+        if palette is not None:
+            img = palette(img)
+        if out is None:
+            out = np.empty((len(frames), *img.shape), dtype=np.uint8)
+        out[n] = img
+    return out
+
+def _frame_stream(scene, chunks, workers):
+    #frames in order, chunks rendered by a pool of workers (0 or 1: in this process)
+    if workers <= 1:
+        _scene_init(scene)
+        for frame_chunk in chunks:
+            yield from _render_frames(frame_chunk)
+        return
+    with mp.Pool(workers, _scene_init, (scene,)) as pool:
+        for imgs in pool.imap(_render_frames, chunks):
+            yield from imgs
+
+def shared_palette(imgs, colors=64):
+    #one adaptive palette (at most 255 colors) for a whole animation, from a few representative RGB frames
+    return Image.fromarray(np.concatenate(imgs)).quantize(min(colors, 255), method=Image.Quantize.MEDIANCUT)
+
+class PaletteMap:
+    '''
+    Exact nearest color mapping of RGB frames (H,W,3) onto a fixed palette image
+    Image.quantize(palette=...) goes through a coarse color cache and shifts flat
+    areas such as the white background, here every 24 bit color seen is matched
+    once and kept in a lookup table
+    '''
+    def __init__(self, palette):
+        self.colors = np.array(palette.getpalette(), dtype=np.int32).reshape(-1,3)[:255]
+        self.lut = np.full(1 << 24, 255, dtype=np.uint8) #255 = not matched yet
+
+    def __call__(self, img):
+        img = img.astype(np.int32)
+        key = (img[...,0] << 16) | (img[...,1] << 8) | img[...,2]
+        idx = self.lut[key]
+        miss = idx == 255
+        if miss.any():
+            new = np.unique(key[miss])
+            rgb = np.stack([new >> 16, (new >> 8) & 255, new & 255], axis=1)
+            self.lut[new] = np.argmin(((rgb[:,None,:] - self.colors[None,:,:])**2).sum(axis=2), axis=1)
+            idx = self.lut[key]
+        return idx
+
+def save_gif(opfile_path, frames, palette, duration_ms):
+    '''
+    Writes palette index frames (H,W) sharing palette as a looping GIF
+    frames can be any iterable, it is consumed once
+    '''
+    colors = palette.getpalette()
+    def images():
+        for idx in frames:
+            im = Image.fromarray(idx)
+            im.putpalette(colors)
+            yield im
+    stream = images()
+    first = next(stream)
+    first.save(opfile_path, save_all=True, append_images=stream, duration=duration_ms, loop=0,
+               optimize=False)
+    return opfile_path
+
+def _render_run(scene, T, dt, opfile_path, stride, workers, chunk):
+    stride = max(int(stride), 1)
+    frames = np.arange(0, T, stride)
+    chunks = [frames[k:k+chunk] for k in range(0, len(frames), chunk)]
+    workers = min(os.cpu_count() or 1, len(chunks)) if workers is None else workers
+
+    os.makedirs(os.path.dirname(opfile_path) or '.', exist_ok=True)
+    if opfile_path.lower().endswith('.gif'):
+        #first and last frame hold every color that shows up in the run
+        _scene_init(scene)
+        scene = dict(scene, palette=shared_palette(_render_frames([frames[0], frames[-1]])))
+        save_gif(opfile_path, _frame_stream(scene, chunks, workers), scene['palette'], 1000*dt*stride)
+    else:
+        with imageio.get_writer(opfile_path, mode='I', fps=1.0/(dt*stride), macro_block_size=1) as writer:
+            for img in _frame_stream(scene, chunks, workers):
+                writer.append_data(img)
     print(f'Saved {opfile_path} succesfully')
+    return opfile_path
 
-def view_gif_together(gif_paths,outpath='postrun_plots/together.gif'):
-
+def _run_scene(boundary, static_obslist, dyn_obslist, sim_traj, p : Parameters, dpi):
+    sim_traj = np.stack(sim_traj, axis=0) #ensure right size
+    simxy = np.ascontiguousarray(sim_traj[:,:2]) #pos only
+    T = len(simxy)
+    #dynamic obstacles for every step at once, (M,T,5)
+    poses = path_planning.DynObsTable(dyn_obslist).states(p.dt*np.arange(T), path_planning.dynobs_inflation(p))
+    return {'boundary': boundary, 'static_obslist': static_obslist, 'simxy': simxy, 'poses': poses,
+            'figsize': (7,7), 'dpi': dpi}
+
+def videoanim(boundary,static_obslist,dyn_obslist,sim_traj,p : Parameters,completed_len, opfile_path = 'postrun_plots/mpcrun.gif',
+              stride=1, workers=None, chunk=16, dpi=100):
+    '''
+    Renders the run to opfile_path (.gif, or .mp4 with imageio-ffmpeg installed)
+    All obstacle poses are computed in one pass, the static map is drawn once per render
+    process and chunks of frames are rendered on Agg by worker processes (0 or 1 renders
+    in this process), then fed to the encoder in order as they arrive
+    GIF frames are quantized by the workers to one palette shared by the whole run
+    stride: render every stride-th step for quick previews, playback stays real time
+    '''
+    print('Working on prdoucing GIF')
+    scene = _run_scene(boundary, static_obslist, dyn_obslist, sim_traj, p, dpi)
+    return _render_run(scene, len(scene['simxy']), p.dt, opfile_path, stride, workers, chunk)
+
+def view_run_together(boundary,static_obslist,dyn_obslist,sim_traj,commands,p : Parameters,
+                      outpath='postrun_plots/together.gif', stride=1, workers=None, chunk=16, dpi=100):
+    '''
+    v(t), w(t) and the map side by side straight from the simulation arrays, same layout
+    as view_gif_together on the linvel, angvel and mpcrun GIFs without writing those first
+    '''
+    print('Working on the combined GIF')
+    scene = _run_scene(boundary, static_obslist, dyn_obslist, sim_traj, p, dpi)
+    commands = np.asarray(commands, dtype=np.float64)
+    T = min(len(scene['simxy']), len(commands)) #sim_traj also holds the initial state
+    scene.update(commands=commands[:T], dt=p.dt, figsize=(7*(1 + 2*4/3), 7))
+    return _render_run(scene, T, p.dt, outpath, stride, workers, chunk)
+
+def view_gif_together(gif_paths,outpath='postrun_plots/together.gif', fps=10, colors=64):
+    '''
+    Puts GIFs side by side, all scaled to the height of the first one, until the shortest ends
+    Inputs are decoded one frame at a time and every canvas is quantized to one palette
+    (from the first and last canvas) before it is handed to the writer
+    '''
     #Create outpath 
     os.makedirs(os.path.dirname(outpath) or '.', exist_ok=True)  
 
-    #Loading Helper
-    def load_gif(path):
-        im = Image.open(path)
-        frames,durations = [],[]
-        for f in ImageSequence.Iterator(im):
-            frames.append(f.convert('RGBA'))
-            durations.append(f.info.get('duration',im.info.get('duration',40)))
-        return frames, durations
-    
-    gifs = [load_gif(gif) for gif in gif_paths]
-    frames_list = [gif[0] for gif in gifs]
-    duration_list = [gif[1] for gif in gifs]
-    lengths = [len(frame) for frame in frames_list]
-
-    #stop when first ends
-    N = min(lengths)
-    idxmaps = [list(range(N)) for _ in gif_paths]
-
-    height = frames_list[0][0].height
-    
-    #Helper for resize
-    def resize_byh(frame,h):
-        w = int(round(frame.width * (h / frame.height)))
-        return frame.resize((w,h), Image.BICUBIC)
-    
-    #Resize all the frames
-    frames_list = [
-        [resize_byh(frame, height) for frame in frames] 
-        for frames in frames_list
-    ]
-
-    #Put together frames
-    fps = 10
-    dur_ms = max(fps,int(round(1000.0 / fps)))
-    op_frames = []
-    durations = [dur_ms] * N
+    gifs = [Image.open(path) for path in gif_paths]
+    N = min(getattr(gif, 'n_frames', 1) for gif in gifs) #stop when first ends
+    height = gifs[0].height
+    widths = [int(round(gif.width * (height / gif.height))) for gif in gifs]
     bg = (255,255,255)
 
-    for i in range(N):
-        frames = [frames_list[g][idxmaps[g][i]] for g in range(len(gif_paths))] #doubleloop thru to select frames
-
-        w = sum(frame.width for frame in frames) #canvas width
-        h = height
-
-        canvas = Image.new('RGBA',(w,h),(*bg, 255))
+    def canvas_at(i):
+        canvas = Image.new('RGB',(sum(widths),height),bg)
         x_cursor = 0
-        
-        for frame in frames:
+        for gif, w in zip(gifs, widths):
+            gif.seek(i)
+            frame = gif.convert('RGBA')
+            if frame.size != (w, height):
+                frame = frame.resize((w,height), Image.BICUBIC)
             canvas.paste(frame,(x_cursor,0), frame)
-            x_cursor += frame.width
-        
-        op_frames.append(canvas.convert('P',palette = Image.ADAPTIVE))
-        
-
-    
-    #save as GIF
-    op_frames[0].save(outpath,save_all = True,
-                       append_images = op_frames[1:],
-                       duration = durations,
-                       loop = 0,
-                       disposal = 2,
-                       optimize = False)
-    
+            x_cursor += w
+        return np.asarray(canvas)
+
+    def frames():
+        for i in range(N):
+            yield to_palette(canvas_at(i))
+
+    try:
+        palette = shared_palette([canvas_at(0), canvas_at(N - 1)], colors)
+        to_palette = PaletteMap(palette)
+        save_gif(outpath, frames(), palette, max(fps,int(round(1000.0 / fps))))
+    finally:
+        for gif in gifs:
+            gif.close()
     return outpath
 
 
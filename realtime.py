@@ -0,0 +1,233 @@
+import time
+import threading
+import numpy as np
+import path_planning
+from parameters import Parameters
+from mpcopEn import dyn_prop_np, Controller
+from telemetry import Telemetry
+
+#Per tick log of RealtimeRunner
+RT_COLUMNS = ('jitter_ms', #tick start - scheduled tick time
+              'latency_ms', #tick start -> command sent
+              't_solve_ms', #wall time of the solve that produced the command (nan on fallback)
+              'deadline_miss', #1 if no fresh solution by the deadline
+              'solve_failed', #1 if the solve raised
+              'fallback', #0 fresh solution, 1 shifted tail of an older one, 2 braking
+              'tail_index', #stages the applied command is into its solution
+              'v', 'w', 'path_dev', 'clearance')
+
+FRESH, TAIL, BRAKE = 0, 1, 2
+
+
+class SimPlant:
+    '''
+    Unicycle stand-in for the vehicle, integrated with the same model as the
+    closed loop simulation, one p.dt step per command
+    time_scale: simulated seconds per wall clock second the runner schedules
+    ticks with, 1.0 is real time, 10.0 runs ten times faster
+    '''
+    def __init__(self, p : Parameters, x0, time_scale=1.0):
+        self.p = p
+        self.x = np.asarray(x0, dtype=np.float64)[:p.n_states].copy()
+        self.time_scale = time_scale
+        self.lock = threading.Lock()
+
+    def state(self):
+        with self.lock:
+            return self.x.copy()
+
+    def apply(self, u):
+        with self.lock:
+            self.x = dyn_prop_np(self.x, u, self.p).flatten()
+
+
+def brake_command(u_prev, p : Parameters):
+    #v and w towards zero as fast as the acceleration limits allow
+    v, w = u_prev
+    #the change is -clip(v, ...), so it stays within [acc_min, acc_max]*dt
+    v -= np.clip(v, -p.lin_acc_max*p.dt, -p.lin_acc_min*p.dt)
+    w -= np.clip(w, -p.ang_acc_max*p.dt, -p.ang_acc_min*p.dt)
+    return np.array([v, w])
+
+class RealtimeRunner:
+    '''
+    Fixed rate control loop on the wall clock: every p.dt (scaled by plant.time_scale)
+    the plant state is sampled and handed to a solver thread, the runner waits at most
+    deadline for the answer and always sends a command:
+        fresh solution by the deadline -> its first stage
+        late or failed solve -> next stage of the newest solution (anytime fallback),
+                                a solve still running keeps the solver busy, its result
+                                is used once it arrives, shifted by the ticks it is late
+        no usable stage left -> brake_command
+    A failed solve never stops the loop
+    controller: built mpcopEn.Controller, it is only ever called from the solver thread
+    deadline: seconds of simulated time, defaults to 0.8 p.dt
+    max_tail: oldest stage of a solution still used before braking, defaults to N_hor-1
+    '''
+    def __init__(self, p : Parameters, controller : Controller, plant : SimPlant, deadline=None, max_tail=None,
+                 t_lead=2):
+        self.p, self.controller, self.plant = p, controller, plant
+        self.deadline = 0.8*p.dt if deadline is None else deadline
+        if not 0.0 < self.deadline < p.dt:
+            raise ValueError(f'deadline {self.deadline} s must be in (0, dt={p.dt} s)')
+        self.max_tail = p.N_hor - 1 if max_tail is None else max_tail
+        self.t_lead = t_lead #ticks the dynamic obstacles are looked ahead, as in closed_loop
+        self.cond = threading.Condition()
+        self.request = None #(tick, x, u_prev, ref window, t) waiting for the solver thread
+        self.result = None #(tick, u_seq or None, solve seconds, error) of the last finished solve
+        self.busy = False
+        self.stop = False
+
+    def _solver_loop(self):
+        while True:
+            with self.cond:
+                while self.request is None and not self.stop:
+                    self.cond.wait()
+                if self.stop:
+                    return
+                tick, x, u_prev, seg, t = self.request
+                self.request = None
+            t0 = time.perf_counter()
+            try:
+                u_seq, error = self.controller.solve(x, u_prev, seg, t), None
+            except Exception as e: #any solver error is handled by the fallback
+                u_seq, error = None, e
+            with self.cond:
+                self.result = (tick, u_seq, time.perf_counter() - t0, error)
+                self.busy = False
+                self.cond.notify_all()
+
+    def run(self, ref_trajectory, steps=None, verbose=False, sdf=None):
+        '''
+        sdf: SignedDistanceField for the clearance column, defaults to the cached one of p's map
+        returns sim_traj, commands and the per tick Telemetry (RT_COLUMNS)
+        '''
+        p, plant = self.p, self.plant
+        steps = int(1.25*len(ref_trajectory)) if steps is None else steps
+        scale = plant.time_scale
+        period, deadline = p.dt/scale, self.deadline/scale
+        self.controller.reset(episode_steps=steps + self.t_lead + 1)
+        tracker = path_planning.RefTracker(ref_trajectory)
+        if sdf is None:
+            sdf = path_planning.signed_distance_field(p.obstacles, p.boundaries)
+        tel = Telemetry(steps, RT_COLUMNS)
+        sim_traj, commands = [plant.state()], np.zeros((steps, p.n_cmds))
+        u_prev = np.zeros(p.n_cmds)
+        best = None #(tick the solution was sampled at, u_seq)
+
+        self.stop, self.busy, self.request, self.result = False, False, None, None
+        solver = threading.Thread(target=self._solver_loop, daemon=True)
+        solver.start()
+        t_start = time.perf_counter()
+        try:
+            for k in range(steps):
+                #sleep until the scheduled tick, a late tick starts right away
+                t_tick = t_start + k*period
+                now = time.perf_counter()
+                if now < t_tick:
+                    time.sleep(t_tick - now)
+                    now = time.perf_counter()
+                x = plant.state()
+                seg = tracker.window(x, p.N_hor + 1)
+
+                with self.cond:
+                    submitted = not self.busy
+                    if submitted:
+                        self.busy = True
+                        self.request = (k, x, u_prev.copy(), seg, (k + self.t_lead)*p.dt)
+                        self.cond.notify_all()
+                    #wait for this tick's solve until the deadline
+                    t_deadline = now + deadline
+                    while submitted and self.busy:
+                        remaining = t_deadline - time.perf_counter()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+                    result, self.result = self.result, None
+
+                fresh = False
+                if result is not None:
+                    tick, u_seq, t_solve, error = result
+                    if error is None:
+                        best = (tick, np.asarray(u_seq, dtype=np.float64).reshape(p.N_hor, p.n_cmds))
+                        fresh = tick == k
+                        tel.record(k, t_solve_ms=1e3*t_solve)
+                    else:
+                        tel.record(k, solve_failed=1.0)
+                        if verbose:
+                            print(f'Tick {k}: solve failed ({error})')
+
+                tail = k - best[0] if best is not None else None
+                if fresh:
+                    u, mode = best[1][0], FRESH
+                elif tail is not None and tail <= self.max_tail:
+                    u, mode = best[1][tail], TAIL
+                else:
+                    u, mode, tail = brake_command(u_prev, p), BRAKE, np.nan
+                plant.apply(u)
+                t_sent = time.perf_counter()
+
+                u_prev = np.array(u, dtype=np.float64)
+                commands[k] = u_prev
+                x_new = plant.state()
+                sim_traj.append(x_new)
+                tel.record(k, jitter_ms=1e3*(now - t_tick), latency_ms=1e3*(t_sent - now),
+                           deadline_miss=float(not fresh), fallback=float(mode), tail_index=tail,
+                           v=u_prev[0], w=u_prev[1], path_dev=tracker.dist,
+                           clearance=float(sdf(x_new[:2])[0]))
+                if verbose and mode != FRESH:
+                    print(f'Tick {k}: {"tail stage " + str(tail) if mode == TAIL else "braking"}')
+        finally:
+            with self.cond:
+                self.stop = True
+                self.cond.notify_all()
+            solver.join(timeout=10*period + 1.0) #a hung solve is abandoned with the daemon thread
+        return sim_traj, commands, tel
+
+def realtime_stats(tel, verbose=True):
+    '''
+    Jitter / latency percentiles, deadline misses and fallback counts of a run
+    '''
+    def pct(col):
+        vals = tel[col][~np.isnan(tel[col])]
+        if len(vals) == 0:
+            return {'p50': np.nan, 'p95': np.nan, 'p99': np.nan, 'max': np.nan}
+        return {'p50': float(np.percentile(vals, 50)), 'p95': float(np.percentile(vals, 95)),
+                'p99': float(np.percentile(vals, 99)), 'max': float(vals.max())}
+    fallback = tel['fallback']
+    #longest run of ticks without a fresh solution
+    streak, longest = 0, 0
+    for miss in tel['deadline_miss']:
+        streak = streak + 1 if miss else 0
+        longest = max(longest, streak)
+    stats = {'ticks': int(tel.n),
+             'jitter_ms': pct('jitter_ms'),
+             'latency_ms': pct('latency_ms'),
+             'solve_ms': pct('t_solve_ms'),
+             'deadline_misses': int(np.nansum(tel['deadline_miss'])),
+             'miss_rate': float(np.nanmean(tel['deadline_miss'])) if tel.n else np.nan,
+             'solve_failures': int(np.nansum(tel['solve_failed'])),
+             'tail_ticks': int(np.sum(fallback == TAIL)),
+             'brake_ticks': int(np.sum(fallback == BRAKE)),
+             'longest_miss_streak': longest}
+    if verbose:
+        print(f'{stats["ticks"]} ticks, {stats["deadline_misses"]} deadline misses '
+              f'({100*stats["miss_rate"]:.1f}%), {stats["solve_failures"]} failed solves, '
+              f'{stats["tail_ticks"]} on the previous tail, {stats["brake_ticks"]} braking, '
+              f'longest miss streak {longest}')
+        print(f'jitter p50 {stats["jitter_ms"]["p50"]:.3f} ms, p99 {stats["jitter_ms"]["p99"]:.3f} ms, '
+              f'max {stats["jitter_ms"]["max"]:.3f} ms, latency p99 {stats["latency_ms"]["p99"]:.2f} ms')
+    return stats
+
+def run_realtime(p : Parameters, ref_trajectory, controller : Controller, time_scale=1.0, deadline=None,
+                 steps=None, verbose=True, telemetry_path=None, sdf=None):
+    '''
+    RealtimeRunner against a SimPlant starting at the first reference state
+    verbose: per tick fallback messages, the summary is always printed
+    returns sim_traj, commands and the realtime_stats dict
+    '''
+    plant = SimPlant(p, ref_trajectory[0], time_scale)
+    sim_traj, commands, tel = RealtimeRunner(p, controller, plant, deadline).run(ref_trajectory, steps, verbose, sdf)
+    if telemetry_path is not None:
+        tel.save(telemetry_path)
+    return sim_traj, commands, realtime_stats(tel)
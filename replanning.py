@@ -0,0 +1,74 @@
+import time
+import numpy as np
+import path_planning
+from parameters import Parameters
+
+
+class Replanner:
+    '''
+    Replanning hook for mpcopEn.closed_loop
+    Every step check() looks at the distance to the reference path, when the
+    vehicle is max_dev off the path (tracking) or has moved less than
+    min_progress over the last stall_steps steps (stall), replan() queries the
+    map planner from the current position for a new reference. The solver
+    server keeps running, only z changes
+    Every replan is logged in events
+    '''
+    def __init__(self, planner : path_planning.PathPlanner, goal, max_dev=1.5, stall_steps=30,
+                 min_progress=0.3, cooldown=20, goal_tol=0.5, max_replans=20):
+        self.planner = planner
+        self.goal = np.asarray(goal, dtype=float)
+        self.max_dev, self.stall_steps, self.min_progress = max_dev, stall_steps, min_progress
+        self.cooldown, self.goal_tol, self.max_replans = cooldown, goal_tol, max_replans
+        self.history = np.zeros((stall_steps, 2)) #ring buffer of the last positions
+        self.last_replan = 0
+        self.deviation = 0.0
+        self.events = []
+
+    def check(self, i, x, deviation):
+        '''
+        deviation: distance from x to the reference path (RefTracker.dist)
+        Returns the reason to replan at step i ('tracking', 'stall') or None
+        '''
+        pos = np.asarray(x[:2], dtype=float)
+        self.deviation = deviation
+        self.history[i % self.stall_steps] = pos
+        if len(self.events) >= self.max_replans or i - self.last_replan < self.cooldown:
+            return None
+        if np.linalg.norm(pos - self.goal) < self.goal_tol:
+            return None
+        if deviation > self.max_dev:
+            return 'tracking'
+        if i >= self.stall_steps:
+            #oldest entry of the ring buffer is the position stall_steps - 1 steps ago
+            moved = np.linalg.norm(pos - self.history[(i + 1) % self.stall_steps])
+            if moved < self.min_progress:
+                return 'stall'
+        return None
+
+    def replan(self, p : Parameters, i, x, ref_trajectory, reason, v0=0.0):
+        '''
+        New reference from the current position to the goal, its speed profile
+        starts at v0
+        Returns the old reference if the query fails (e.g. the vehicle sits
+        inside an inflated obstacle)
+        '''
+        t0 = time.perf_counter()
+        self.last_replan = i
+        event = {'step': i, 't': i*p.dt, 'reason': reason, 'pos': (float(x[0]), float(x[1])),
+                 'tracking_error': float(self.deviation)}
+        try:
+            path = self.planner.query(x[:2], self.goal)
+            ref_trajectory = path_planning.generate_reftrajectory(p, path, v0)
+            event['ok'] = True
+        except (RuntimeError, ValueError) as e:
+            event.update({'ok': False, 'error': str(e)})
+        event['plan_ms'] = 1e3*(time.perf_counter() - t0)
+        self.events.append(event)
+        return ref_trajectory
+
+    def summary(self):
+        for ev in self.events:
+            status = 'ok' if ev['ok'] else f'failed ({ev["error"]})'
+            print(f'Replanned at step {ev["step"]} (t={ev["t"]:.2f} s) on {ev["reason"]}, '
+                  f'tracking error {ev["tracking_error"]:.2f} m, {ev["plan_ms"]:.2f} ms, {status}')
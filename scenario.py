@@ -0,0 +1,189 @@
+import os
+import glob
+import pickle
+import hashlib
+import numpy as np
+import yaml
+import path_planning
+from parameters import Parameters, TUNABLE_FIELDS
+
+DEFAULT_START = (1.0, 25.0)
+DEFAULT_GOAL = (49.0, 30.0)
+SCENARIO_KEYS = {'boundary_coordinates', 'list_of_holes', 'dynamic_obstacles', 'start', 'goal', 'parameters'}
+
+#C loader is several times faster than the pure python one when libyaml is available
+_Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_files = {} #path -> ((mtime, size), {name: Scenario}) for files already parsed in this process
+
+
+class Scenario:
+    '''
+    Everything needed to run one episode: map, dynamic obstacles, start/goal and
+    Parameters overrides, validated on construction
+    '''
+    def __init__(self, name, boundary, holes, dynobs=(), start=DEFAULT_START, goal=DEFAULT_GOAL,
+                 overrides=None):
+        self.name = name
+        self.boundary = _polygon(boundary, f'{name}: boundary_coordinates')
+        self.holes = [_polygon(h, f'{name}: list_of_holes[{k}]') for k, h in enumerate(holes or [])]
+        self.dynobs = [_dynobs(obs, f'{name}: dynamic_obstacles[{k}]') for k, obs in enumerate(dynobs or [])]
+        self.start = _point(start, f'{name}: start')
+        self.goal = _point(goal, f'{name}: goal')
+        self.overrides = dict(overrides or {})
+
+        defaults = Parameters([], [], [])
+        unknown = [key for key in self.overrides if not hasattr(defaults, key)]
+        if unknown:
+            raise ValueError(f'{name}: unknown Parameters fields {unknown}')
+        for key, value in self.overrides.items():
+            self.overrides[key] = _override(value, getattr(defaults, key), key, f'{name}: parameters.{key}')
+        for label, pt in (('start', self.start), ('goal', self.goal)):
+            if not path_planning.points_in_polygon(np.array([pt]), self.boundary)[0]:
+                raise ValueError(f'{name}: {label} {pt} is outside the boundary')
+            if any(path_planning.points_in_polygon(np.array([pt]), h)[0] for h in self.holes):
+                raise ValueError(f'{name}: {label} {pt} is inside an obstacle')
+
+    def params(self):
+        p = Parameters(self.holes, self.boundary, self.dynobs)
+        for key, value in self.overrides.items():
+            setattr(p, key, value)
+        return p
+
+    def planner(self, **kwargs):
+        return path_planning.PathPlanner(self.boundary, self.holes, name=self.name, **kwargs)
+
+    def plan(self, vehicle_width=0.5):
+        '''
+        returns the interpolated path and the inflated obstacles
+        '''
+        planner = self.planner(vehicle_width=vehicle_width)
+        return planner.query(self.start, self.goal), planner.padded_obstacles
+
+    def reference(self, p : Parameters = None):
+        '''
+        Parameters, path, reference trajectory and inflated obstacles, ready for run_mpc
+        '''
+        p = self.params() if p is None else p
+        path, padded_obstacles = self.plan()
+        return p, path, path_planning.generate_reftrajectory(p, path), padded_obstacles
+
+def _point(value, label):
+    pt = np.asarray(value, dtype=np.float64)
+    if pt.shape != (2,) or not np.all(np.isfinite(pt)):
+        raise ValueError(f'{label} must be [x, y], got {value}')
+    return (float(pt[0]), float(pt[1]))
+
+def _polygon(value, label):
+    try:
+        poly = np.asarray(value, dtype=np.float64)
+    except (TypeError, ValueError):
+        raise ValueError(f'{label} must be a list of [x, y] vertices')
+    if poly.ndim != 2 or poly.shape[1] != 2 or len(poly) < 3 or not np.all(np.isfinite(poly)):
+        raise ValueError(f'{label} must be at least 3 [x, y] vertices, got shape {poly.shape}')
+    return poly.tolist()
+
+def _dynobs(value, label):
+    #p1, p2, freq, x_rad, y_rad, heading, same tuple as path_planning.DynObsTable
+    if not isinstance(value, (list, tuple)) or len(value) != 6:
+        raise ValueError(f'{label} must be [p1, p2, freq, x_rad, y_rad, heading]')
+    p1, p2 = _point(value[0], f'{label} p1'), _point(value[1], f'{label} p2')
+    freq, x_rad, y_rad, heading = (float(v) for v in value[2:])
+    if x_rad <= 0 or y_rad <= 0:
+        raise ValueError(f'{label} radii must be positive')
+    return (list(p1), list(p2), freq, x_rad, y_rad, heading)
+
+def _override(value, default, key, label):
+    #value checked against the type of the Parameters default, tunables are real valued
+    #even where the default is written as an int
+    if isinstance(default, bool) or isinstance(default, str):
+        if type(value) is not type(default):
+            raise ValueError(f'{label} must be a {type(default).__name__}, got {value!r}')
+        return value
+    if isinstance(default, int) and key not in TUNABLE_FIELDS:
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError(f'{label} must be an int, got {value!r}')
+        return value
+    if isinstance(default, (int, float)):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not np.isfinite(value):
+            raise ValueError(f'{label} must be a finite number, got {value!r}')
+        return float(value)
+    if isinstance(default, (list, tuple)) and not isinstance(value, (list, tuple)):
+        raise ValueError(f'{label} must be a list, got {value!r}')
+    return value
+
+def parse_scenarios(data, source='<yaml>'):
+    if not isinstance(data, dict):
+        raise ValueError(f'{source}: expected a mapping of scenario names')
+    scenarios = {}
+    for name, entry in data.items():
+        if not isinstance(entry, dict):
+            raise ValueError(f'{source}: scenario {name} must be a mapping')
+        unknown = set(entry) - SCENARIO_KEYS
+        if unknown:
+            raise ValueError(f'{source}: scenario {name} has unknown keys {sorted(unknown)}')
+        for key in ('boundary_coordinates', 'list_of_holes'):
+            if key not in entry:
+                raise ValueError(f'{source}: scenario {name} is missing {key}')
+        scenarios[name] = Scenario(name, entry['boundary_coordinates'], entry['list_of_holes'],
+                                   entry.get('dynamic_obstacles'), entry.get('start', DEFAULT_START),
+                                   entry.get('goal', DEFAULT_GOAL), entry.get('parameters'))
+    return scenarios
+
+def _cache_salt():
+    #pickles of an older validation or Parameters layout must not be served, the
+    #salt changes with this module's source and the Parameters field names
+    with open(__file__, 'rb') as file:
+        source = file.read()
+    fields = ','.join(sorted(vars(Parameters([], [], [])))).encode()
+    return hashlib.sha256(source + b'\0' + fields).digest()
+
+def load_scenarios(path='obsbounds.yaml', cache_dir=os.path.join(path_planning.CACHE_DIR, 'scenarios')):
+    '''
+    All scenarios of one YAML file as {name: Scenario}
+    Unchanged files (mtime, size) are served from memory, otherwise the parsed result
+    is looked up on disk by content hash (salted, see _cache_salt) before falling back
+    to parsing the YAML
+    '''
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    if path in _files and _files[path][0] == stamp:
+        return _files[path][1]
+
+    with open(path, 'rb') as file:
+        raw = file.read()
+    cache_file, scenarios = None, None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, hashlib.sha256(_cache_salt() + raw).hexdigest()[:20] + '.pkl')
+        try:
+            with open(cache_file, 'rb') as file:
+                scenarios = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass #missing or stale, parsed below
+    if scenarios is None:
+        scenarios = parse_scenarios(yaml.load(raw, Loader=_Loader), path)
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'wb') as file:
+                pickle.dump(scenarios, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+    _files[path] = (stamp, scenarios)
+    return scenarios
+
+def load_scenario(name, path='obsbounds.yaml'):
+    scenarios = load_scenarios(path)
+    if name not in scenarios:
+        raise KeyError(f'No scenario {name} in {path}, available: {sorted(scenarios)}')
+    return scenarios[name]
+
+def load_scenario_dir(directory, pattern='*.yaml'):
+    '''
+    Scenarios of every matching file in directory, keyed '<file stem>/<name>'
+    '''
+    scenarios = {}
+    for path in sorted(glob.glob(os.path.join(directory, pattern))):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        for name, scn in load_scenarios(path).items():
+            scenarios[f'{stem}/{name}'] = scn
+    return scenarios
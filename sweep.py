@@ -0,0 +1,147 @@
+import os
+import csv
+import time
+import itertools
+import multiprocessing as mp
+import numpy as np
+import opengen as og
+import yaml
+import path_planning
+from parameters import Parameters, TUNABLE_FIELDS
+import mpcopEn
+
+_worker = {} #solver and map cache of the current worker process
+
+METRIC_FIELDS = ['episode', 'config', 'n_dynobs', 'weights', 'success', 'min_clearance',
+                 'mean_solve_ms', 'max_solve_ms', 'path_length', 'completion_time', 'wall_time', 'error']
+
+
+def episode_grid(configs, dynobs_sets, weight_sets):
+    '''
+    Every combination of map, dynamic obstacle set and weight overrides
+    weight_sets: list of dicts {field: value}, fields must be in TUNABLE_FIELDS so
+    all episodes share one compiled optimizer
+    '''
+    episodes = []
+    for k, (config, dynobs, weights) in enumerate(itertools.product(configs, dynobs_sets, weight_sets)):
+        bad = set(weights) - set(TUNABLE_FIELDS)
+        if bad:
+            raise ValueError(f'Weights {sorted(bad)} are compiled into the solver and cannot be swept')
+        episodes.append({'episode': k, 'config': config, 'dynobs': dynobs, 'weights': weights})
+    return episodes
+
+def episode_params(ep, maps):
+    if ep['config'] not in maps:
+        maps[ep['config']] = path_planning.gen_path(ep['config'])[:3]
+    path, obstacles, boundary = maps[ep['config']]
+    p = Parameters(obstacles, boundary, ep['dynobs'])
+    for field, value in ep['weights'].items():
+        setattr(p, field, value)
+    return p, path
+
+def episode_metrics(p : Parameters, ref_trajectory, sim_traj, tel, sdf, goal_tol=0.5):
+    '''
+    success: goal reached within goal_tol and the vehicle center never entered a wall
+    min_clearance: closest approach to the static walls over the run
+    completion_time: first time the goal is within goal_tol
+    '''
+    traj = np.asarray(sim_traj)[:, :2]
+    clearance = sdf(traj)
+    d_goal = np.linalg.norm(traj - ref_trajectory[-1, :2], axis=1)
+    reached = np.flatnonzero(d_goal <= goal_tol)
+    return {'success': bool(len(reached) > 0 and clearance.min() > 0.0),
+            'min_clearance': float(clearance.min()),
+            'mean_solve_ms': float(np.nanmean(tel['solve_time_ms'])),
+            'max_solve_ms': float(np.nanmax(tel['solve_time_ms'])),
+            'path_length': float(np.sum(np.linalg.norm(np.diff(traj, axis=0), axis=1))),
+            'completion_time': float(reached[0]*p.dt) if len(reached) else np.nan}
+
+def _init_worker(build_dir, name, transport, slots, base_port, started):
+    #must not raise: the pool would respawn the worker, which then waits on an empty slot queue
+    _worker['mng'], _worker['maps'], _worker['error'] = None, {}, ''
+    try:
+        k = slots.get(timeout=10.0) if transport == 'tcp' else None
+        _worker['mng'] = mpcopEn.start_manager(build_dir, name, transport,
+                                               port=None if k is None else base_port + k)
+        if k is not None:
+            started[k] = 1 #only servers that came up are killed by run_sweep
+    except Exception as e: #reported in the rows of this worker's episodes
+        _worker['error'] = f'solver startup failed: {type(e).__name__}: {e}'
+
+def _run_episode(ep):
+    t0 = time.perf_counter()
+    row = {'episode': ep['episode'], 'config': ep['config'], 'n_dynobs': len(ep['dynobs']),
+           'weights': ep['weights'], 'error': ''}
+    try:
+        if _worker['error']:
+            raise RuntimeError(_worker['error'])
+        p, path = episode_params(ep, _worker['maps'])
+        ref_trajectory = path_planning.generate_reftrajectory(p, path)
+        sdf = path_planning.signed_distance_field(p.obstacles, p.boundaries) #built once per map and worker
+        controller = mpcopEn.OpEnController(p, mng=_worker['mng']).build()
+        sim_traj, commands, tel = mpcopEn.closed_loop(p, ref_trajectory, controller, verbose=False, sdf=sdf)
+        row.update(episode_metrics(p, ref_trajectory, sim_traj, tel, sdf))
+    except Exception as e: #a failed episode is a row, it never stops the sweep
+        row.update({'success': False, 'error': f'{type(e).__name__}: {e}'})
+    row['wall_time'] = time.perf_counter() - t0
+    return row
+
+def run_sweep(episodes, workers=None, out='sweep_results.csv', transport='tcp', base_port=8400):
+    '''
+    Spreads closed loop episodes over a process pool, every worker owns one solver
+    (a TCP server on base_port + k, or the in-process bindings)
+    Rows are appended to out as episodes finish
+    '''
+    workers = workers or os.cpu_count()
+    #All episodes must map to the same compiled optimizer
+    maps = {}
+    p0, _ = episode_params(episodes[0], maps)
+    bindings = transport == 'direct'
+    solver_config, build_cfg = mpcopEn.solver_configuration(), mpcopEn.build_configuration(bindings)
+    key = mpcopEn.build_key(p0, solver_config, build_cfg)
+    for ep in episodes[1:]:
+        p, _ = episode_params(ep, maps)
+        if mpcopEn.build_key(p, solver_config, build_cfg) != key:
+            raise ValueError(f'Episode {ep["episode"]} needs a different optimizer build, split the sweep')
+    build_dir, name = mpcopEn.open_solver(p0, python_bindings=bindings)
+
+    slots, started = mp.Queue(), mp.Array('b', workers) #worker k serves on base_port + k
+    for k in range(workers):
+        slots.put(k)
+    rows = []
+    t0 = time.perf_counter()
+    try:
+        with open(out, 'w', newline='') as file, \
+                mp.Pool(workers, _init_worker, (build_dir, name, transport, slots, base_port, started)) as pool:
+            writer = csv.DictWriter(file, fieldnames=METRIC_FIELDS, restval='')
+            writer.writeheader()
+            for row in pool.imap_unordered(_run_episode, episodes):
+                writer.writerow(row)
+                file.flush()
+                rows.append(row)
+                print(f'[{len(rows)}/{len(episodes)}] episode {row["episode"]} {row["config"]} '
+                      f'success={row["success"]} ({row["wall_time"]:.1f} s)')
+    finally:
+        if transport == 'tcp':
+            #opengen retries a refused connection for ~9 s, so never-started ports are skipped
+            for k in range(workers):
+                if not started[k]:
+                    continue
+                try:
+                    og.tcp.OptimizerTcpManager(ip='127.0.0.1', port=base_port + k).kill()
+                except Exception:
+                    pass #server already gone
+    elapsed = time.perf_counter() - t0
+    print(f'{len(rows)} episodes in {elapsed:.1f} s with {workers} workers '
+          f'({len(rows)/elapsed:.2f} episodes/s)')
+    return rows
+
+
+if __name__ == '__main__':
+    with open('obsbounds.yaml', 'r') as file:
+        configs = list(yaml.safe_load(file))
+    oscx, oscy = 8.17127, 29.0021
+    dynobs_sets = [[([oscx, oscy], [oscx, oscy+1], 0.1, 0.2, 0.5, 0.1)],
+                   [([oscx, oscy], [oscx+1, oscy], 0.2, 0.3, 0.3, 0.0)]]
+    weight_sets = [{}, {'pos_dev': 5.0}, {'lin_acc_pen': 1.0, 'heading_dev': 5.0}]
+    run_sweep(episode_grid(configs, dynobs_sets, weight_sets))
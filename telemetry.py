@@ -0,0 +1,48 @@
+import numpy as np
+
+#Default columns recorded by mpcopEn.closed_loop, one row per control step
+COLUMNS = ('t_ref_ms', 't_pack_ms', 't_solve_ms', 't_dyn_ms', 't_diag_ms', #wall clock per phase
+           'solve_time_ms', 'inner_iters', 'outer_iters', 'penalty', #as reported by OpEn
+           'f1_infeasibility', 'f2_norm', 'cost',
+           'clearance', 'd_enforced_min', 'dyn_dist_min', 'path_dev',
+           'objective', 'violation', 'converged', #on the shared build_problem, comparable across backends
+           'cold_solve_time_ms', 'cold_inner_iters',
+           'gap', 'shadow_solve_time_ms', 'shadow_objective', 'shadow_violation', #ShadowController only
+           't_replan_ms') #only set on steps that replanned
+
+
+class Telemetry:
+    '''
+    Per step log stored column wise in preallocated float arrays
+    Recording a step only writes into those arrays, nothing is formatted or printed
+    '''
+    def __init__(self, steps, columns=COLUMNS):
+        self.data = {col: np.full(steps, np.nan) for col in columns}
+        self.n = 0
+
+    def record(self, i, **values):
+        for col, value in values.items():
+            self.data[col][i] = value
+        self.n = max(self.n, i + 1)
+
+    def __getitem__(self, col):
+        return self.data[col][:self.n]
+
+    def columns(self):
+        return list(self.data)
+
+    def save(self, path):
+        #float32 halves the file size and is plenty for timings and residuals
+        np.savez_compressed(path, **{col: values[:self.n].astype(np.float32)
+                                     for col, values in self.data.items()})
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as file:
+            cols = list(file.files)
+            tel = cls(len(file[cols[0]]) if cols else 0, cols)
+            for col in cols:
+                tel.data[col][:] = file[col]
+        tel.n = len(tel.data[cols[0]]) if cols else 0
+        return tel